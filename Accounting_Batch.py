@@ -0,0 +1,103 @@
+#This script will run the quarter end close for several companies at once
+#Each company has its own workbook with the same sheets as Transactions_Raw.xlsx, and is processed in its own worker process
+#Output is 1 FS_BS file per company, and 1 consolidated summary of all companies
+
+#Usage: python Accounting_Batch.py 2023-12-31 CompanyA.xlsx CompanyB.xlsx --output reports --workers 4
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from Accounting_Demo import close_books, write_statements, return_quarter_int
+
+
+#Name of every company, from its workbook's file name. Workbooks with the same file name in different folders are named after their folder too
+def entity_names(workbooks):
+    paths = [os.path.abspath(workbook) for workbook in workbooks]
+    repeated = sorted({workbook for workbook, path in zip(workbooks, paths) if paths.count(path) > 1})
+    if repeated:
+        raise ValueError('Workbooks given more than once: ' + ', '.join(repeated))
+
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    names = [os.path.basename(os.path.dirname(path)) + ' ' + name if names.count(name) > 1 else name for path, name in zip(paths, names)]
+    clashes = sorted({workbook for workbook, name in zip(workbooks, names) if names.count(name) > 1})
+    if clashes:
+        raise ValueError('Workbooks that cannot be told apart by file and folder name, rename them: ' + ', '.join(clashes))
+    return names
+
+
+#Close the books of 1 company and export its statements, return the P&L and Balance Sheet for the consolidated summary
+def close_entity(workbook, entity, date_input, output_dir, chart_file = None, levels_file = None):
+    statements = close_books(workbook, date_input, chart_file = chart_file, levels_file = levels_file)
+
+    output_file = os.path.join(output_dir, date_input[:10] + ' ' + entity + ' FS_BS.xlsx')
+    write_statements(statements, output_file)
+
+    return entity, output_file, statements['Profit & Loss YTD'], statements['Balance Sheet Today']
+
+
+#Place this year's P&L YTD and this quarter's Balance Sheet of every company side by side, and add up the consolidated total
+def consolidate(results, date_input):
+    this_year = int(date_input[:4])
+    this_quarter = str(this_year) + 'Q' + str(return_quarter_int(int(date_input[5:7])))
+
+    profit_loss = {}
+    balance_sheet = {}
+    for entity, output_file, profit_loss_year_output, balance_sheet_output in results:
+        profit_loss[entity] = profit_loss_year_output.set_index('P&L Category').get(this_year, pd.Series(dtype = float))
+        balance_sheet[entity] = balance_sheet_output.set_index(['Category','Asset Category']).get(this_quarter, pd.Series(dtype = float))
+
+    profit_loss = pd.concat(profit_loss, axis = 1).fillna(0)
+    profit_loss['Consolidated'] = profit_loss.sum(axis = 1)
+
+    balance_sheet = pd.concat(balance_sheet, axis = 1).fillna(0).sort_index(level = 'Asset Category', sort_remaining = False)
+    balance_sheet['Consolidated'] = balance_sheet.sum(axis = 1)
+
+    return {'P&L YTD by Company': profit_loss.round(2).reset_index(), 'Balance Sheet by Company': balance_sheet.round(2).reset_index()}
+
+
+#chart_file and levels_file are used for every company
+def run_batch(workbooks, date_input, output_dir = '.', workers = None, chart_file = None, levels_file = None):
+    entities = entity_names(workbooks)
+    os.makedirs(output_dir, exist_ok = True)
+
+    results = []
+    run_status = []
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(close_entity, workbook, entity, date_input, output_dir, chart_file, levels_file) for workbook, entity in zip(workbooks, entities)]
+
+        #Keep going if 1 company fails, the error is shown in the Run Status sheet
+        for workbook, entity, future in zip(workbooks, entities, futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                run_status.append({'Company': entity, 'Workbook': os.path.abspath(workbook), 'Output': '', 'Status': type(error).__name__ + ': ' + str(error)})
+                continue
+            results.append(result)
+            run_status.append({'Company': entity, 'Workbook': os.path.abspath(workbook), 'Output': result[1], 'Status': 'OK'})
+
+    summary = consolidate(results, date_input) if results else {}
+    summary['Run Status'] = pd.DataFrame(run_status)
+
+    summary_file = os.path.join(output_dir, date_input[:10] + ' Consolidated Summary.xlsx')
+    write_statements(summary, summary_file)
+    return summary_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate financial statements for several companies as of the same date')
+    parser.add_argument('date', help = 'date of report in YYYY-MM-DD format')
+    parser.add_argument('workbooks', nargs = '+', help = 'transaction workbook of each company')
+    parser.add_argument('--output', default = '.', help = 'folder for the FS_BS files and the consolidated summary')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of worker processes (default: number of cores)')
+    parser.add_argument('--chart', help = 'chart of accounts of every company, a CSV file or a workbook with a Chart of Accounts sheet (default: Chart_of_Accounts.csv)')
+    parser.add_argument('--levels', help = 'inventory level thresholds per item and shop, a CSV file or a workbook with an Inventory Levels sheet')
+    args = parser.parse_args()
+
+    try:
+        entity_names(args.workbooks)
+    except ValueError as error:
+        parser.error(str(error))
+    print(run_batch(args.workbooks, args.date, args.output, args.workers, args.chart, args.levels))
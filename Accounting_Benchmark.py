@@ -0,0 +1,194 @@
+#This script will measure how long the quarter end close takes as the ledger grows
+#It generates a synthetic ledger (same Transaction, Price List and Shop Space sheets as Transactions_Raw.xlsx) of the size given,
+#runs Accounting_Demo.py on it and times each phase with the run diagnostics spans (load, inventory, COGS, T-Accounts, tax, statements, export)
+#Results are printed and appended to a CSV file, so that runs can be compared over time
+
+#Usage: python Accounting_Benchmark.py --days 365 --shops 10 --skus 50 --transactions-per-day 500 --results Benchmark_Results.csv
+
+import argparse
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from Accounting_Demo import Ledger, generate_statements, write_workbook, write_statements, span, enable_diagnostics, disable_diagnostics
+
+
+'''
+Synthetic ledger: the company is funded on the first day, buys stock into the main warehouse, restocks every shop, and sells
+transactions_per_day items a day across all shops. Rent, transport, advertising, equipment, depreciation, dividends and tax payments
+are added on a fixed schedule so that every statement has something to show
+'''
+
+#Days between restocking of the shops, units sold since the last restocking are transferred from the warehouse
+restock_days = 7
+
+
+def generate_ledger(days = 365, shops = 3, skus = 7, transactions_per_day = 10, start = '2022-01-01', seed = 0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods = days, freq = 'D')
+    item_names = np.array(['Item' + str(i + 1).zfill(len(str(skus))) for i in range(skus)], dtype = object)
+    shop_names = np.array(['Shop' + str(i + 1).zfill(len(str(shops))) for i in range(shops)], dtype = object)
+
+    #Sale prices are unique within a price list, so that every sale matches exactly 1 item. Prices go up 5% every year
+    base_price = 10.0 + 3.0*np.arange(skus)
+    price_years = range(dates[0].year, dates[-1].year + 1)
+    price_list = pd.DataFrame({'Item_Name': np.tile(item_names, len(price_years)),
+                               'Sale_Price': np.concatenate([np.round(base_price * 1.05**n, 2) for n in range(len(price_years))]),
+                               'Product_Code': np.tile(['P' + name[4:] for name in item_names], len(price_years)),
+                               'Effective_From': np.repeat(pd.to_datetime([str(year) + '-01-01' for year in price_years]), skus)})
+    price_list['Effective_From'] = price_list['Effective_From'].clip(lower = dates[0])
+    cost_price = dict(zip(item_names, np.round(base_price * 0.6, 2)))
+
+    '''
+    Sales: random item and shop, at the price of the year
+    '''
+    n_sales = days * transactions_per_day
+    sale_day = np.repeat(np.arange(days), transactions_per_day)
+    sale_item = rng.integers(0, skus, n_sales)
+    sale_shop = rng.integers(0, shops, n_sales)
+    year_index = dates.year.to_numpy()[sale_day] - dates[0].year
+    sale_price = np.round(base_price[sale_item] * 1.05**year_index, 2)
+    sales = pd.DataFrame({'Date': dates[sale_day], 'Debit': 'Cash', 'Debit_Amount': sale_price, 'Credit_Amount': sale_price,
+                          'Credit': 'Revenue', 'Comments': shop_names[sale_shop], 'Quantity': np.nan, 'Ref_Number': np.nan, 'Item_Name': np.nan})
+
+    '''
+    Stock: every shop starts with enough stock for 2 restocking periods, then gets back what it sold at every restocking
+    '''
+    opening_qty = int(np.ceil(2 * restock_days * transactions_per_day / (skus * shops))) + 5
+    shop_space = pd.DataFrame({'Item_Name': np.tile(item_names, shops), 'Shop_Name': np.repeat(shop_names, skus),
+                               'Slots': rng.integers(opening_qty, 2 * opening_qty + 1, skus * shops), 'Effective_From': dates[0]})
+    sold = pd.DataFrame({'Period': sale_day // restock_days + 1, 'Item_Name': item_names[sale_item], 'Shop_Name': shop_names[sale_shop]})
+    restock = sold[sold['Period'] * restock_days < days].groupby(['Period','Item_Name','Shop_Name']).size().rename('Quantity').reset_index()
+    opening = pd.DataFrame({'Period': 0, 'Item_Name': np.tile(item_names, shops), 'Shop_Name': np.repeat(shop_names, skus), 'Quantity': opening_qty})
+    restock = pd.concat([opening, restock], axis = 0, ignore_index = True)
+    restock['Date'] = dates[restock['Period'] * restock_days]
+
+    transfers = pd.DataFrame({'Date': restock['Date'], 'Debit': 'Inventory_' + restock['Shop_Name'], 'Debit_Amount': np.nan, 'Credit_Amount': np.nan,
+                              'Credit': 'Inventory', 'Comments': 'Restocking ' + restock['Shop_Name'], 'Quantity': restock['Quantity'].astype(float),
+                              'Ref_Number': np.nan, 'Item_Name': restock['Item_Name']})
+
+    #Warehouse buys what is transferred out on the same day, the purchase is taken in before the transfer
+    bought = restock.groupby(['Period','Date','Item_Name'])['Quantity'].sum().reset_index()
+    purchase_value = np.round(bought['Quantity'] * bought['Item_Name'].map(cost_price), 2)
+    purchases = pd.DataFrame({'Date': bought['Date'], 'Debit': 'Inventory', 'Debit_Amount': purchase_value, 'Credit_Amount': purchase_value,
+                              'Credit': np.where(bought['Period'] % 2, 'AP', 'Cash'), 'Comments': 'Purchase of Inventories', 'Quantity': bought['Quantity'].astype(float),
+                              'Ref_Number': 'PO' + bought['Period'].astype(str).str.zfill(5), 'Item_Name': bought['Item_Name']})
+    payments = purchases[purchases['Credit'] == 'AP'].groupby('Ref_Number', as_index = False).agg(Date = ('Date','max'), Debit_Amount = ('Debit_Amount','sum'))
+    payments['Date'] = (payments['Date'] + pd.Timedelta(days = 1)).clip(upper = dates[-1])
+    payments = payments.assign(Debit = 'AP', Credit_Amount = payments['Debit_Amount'], Credit = 'Cash', Comments = 'Payment for ' + payments['Ref_Number'],
+                               Quantity = np.nan, Ref_Number = np.nan, Item_Name = np.nan)
+
+    '''
+    Other transactions on a fixed schedule
+    '''
+    month_starts = dates[dates.is_month_start]
+    quarter_ends = dates[dates.is_quarter_end]
+    year_starts = dates[dates.is_year_start]
+    weeks = dates[::7]
+    scale = transactions_per_day * float(base_price.mean())
+
+    def schedule(on, debit, credit, amount, comments):
+        amount = np.round(np.broadcast_to(amount, len(on)).astype(float), 2)
+        return pd.DataFrame({'Date': on, 'Debit': debit, 'Debit_Amount': amount, 'Credit_Amount': amount, 'Credit': credit,
+                             'Comments': comments, 'Quantity': np.nan, 'Ref_Number': np.nan, 'Item_Name': np.nan})
+
+    others = [schedule(dates[:1], 'Cash', 'Share Capital', scale * 60, 'Issuance of new shares'),
+              schedule(month_starts, 'Rent Expense', 'Cash', scale * 3, 'Rental Payment'),
+              schedule(weeks, 'Transportation Expense', 'Cash', scale * 0.2, 'Petrol'),
+              schedule(month_starts, 'Cash', 'Unearned Ad Revenue', scale * 0.5, 'Brand Campaign'),
+              schedule(month_starts, 'Unearned Ad Revenue', 'Ad Revenue', scale * 0.5, 'Brand Campaign'),
+              schedule(dates[:1].append(year_starts[year_starts > dates[0]]), 'Equipment', 'Cash', scale * 8, 'Purchase of equipment'),
+              schedule(quarter_ends, 'Depreciation Expense', 'Equipment', scale * 0.5, 'Depreciation of equipment'),
+              schedule(year_starts[year_starts > dates[0]] + pd.Timedelta(days = 30), 'Retained Earnings', 'Dividend Payable', scale * 2, 'Declare dividends'),
+              schedule(year_starts[year_starts > dates[0]] + pd.Timedelta(days = 60), 'Dividend Payable', 'Cash', scale * 2, 'Pay Dividend in Cash'),
+              schedule(year_starts[year_starts > dates[0]] + pd.Timedelta(days = 90), 'Tax Payable', 'Cash', scale * 0.5, 'Cash payment for tax')]
+    others = [other[other['Date'] <= dates[-1]] for other in others]
+
+    transactions = pd.concat([*others, purchases, payments, transfers, sales], axis = 0, ignore_index = True)
+    transactions = transactions.sort_values('Date', kind = 'mergesort').reset_index(drop = True)
+    transactions['Quantity'] = transactions['Quantity'].astype(float)
+    return {'Transaction': transactions, 'Price List': price_list, 'Shop Space': shop_space}
+
+
+#Phases in the results, the spans of Accounting_Demo.py's run diagnostics. statements is the time not in any of the other spans
+#load is the first load from Excel and load_cached the load of the run timed, from the cache. Only load_cached counts towards the total
+phases = ['load','load_cached','inventory','cogs','sales_aggregates','t_accounts','stock_check','profit_loss','tax','balance_sheet','equity','cash_flow','statements','export']
+
+
+#Peak memory of the whole process so far in MB, not available on Windows
+def process_peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+#Generate a ledger of the size given, close the books as of its last day and time every phase
+def run_benchmark(days = 365, shops = 3, skus = 7, transactions_per_day = 10, seed = 0, trace_memory = False, work_dir = None):
+    with tempfile.TemporaryDirectory(dir = work_dir) as folder:
+        sheets = generate_ledger(days, shops, skus, transactions_per_day, seed = seed)
+        workbook = os.path.join(folder, 'Benchmark.xlsx')
+        write_workbook(sheets, workbook)
+        as_of = sheets['Transaction']['Date'].max().strftime('%Y-%m-%d')
+
+        try:
+            #First load reads the workbook and builds the Parquet cache, later runs load from the cache
+            first_load = enable_diagnostics(trace_memory)
+            Ledger(workbook, use_snapshot = False)
+
+            diagnostics = enable_diagnostics(trace_memory)
+            ledger = Ledger(workbook, use_snapshot = False)
+            ledger.inventory_as_of(as_of)
+            with span('statements'):
+                statements = generate_statements(ledger, as_of)
+            write_statements(statements, os.path.join(folder, as_of + ' FS_BS.xlsx'))
+        finally:
+            disable_diagnostics()
+
+    summary = diagnostics.summary()
+    summary.loc['load_cached'] = summary.loc['load']
+    summary.loc['load'] = first_load.summary().loc['load']
+
+    n_transactions = len(sheets['Transaction'])
+    #A run loads the workbook once, from the cache
+    total = summary['Seconds'].drop('load').sum()
+    result = {'Run_At': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Days': days, 'Shops': shops, 'SKUs': skus,
+              'Transactions_Per_Day': transactions_per_day, 'Transactions': n_transactions, 'Journal_Rows': len(statements['Transactions Cleaned'])}
+    for name in phases:
+        result[name + '_s'] = summary['Seconds'].get(name, 0.0)
+        if trace_memory:
+            result[name + '_peak_mb'] = round(summary['Peak_MB'].get(name, 0.0), 1)
+    result['total_s'] = round(total, 4)
+    result['transactions_per_s'] = round(n_transactions / total, 1)
+    result['process_peak_mb'] = process_peak_memory()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time each phase of the close on a synthetic ledger')
+    parser.add_argument('--days', type = int, default = 365, help = 'number of days of transactions')
+    parser.add_argument('--shops', type = int, default = 3, help = 'number of shops')
+    parser.add_argument('--skus', type = int, default = 7, help = 'number of items in the price list')
+    parser.add_argument('--transactions-per-day', type = int, default = 10, help = 'items sold per day across all shops (restocking, purchases and expenses come on top)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the random generator')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'number of runs')
+    parser.add_argument('--trace-memory', action = 'store_true', help = 'record the peak memory of each phase with tracemalloc (slows the run down)')
+    parser.add_argument('--results', default = 'Benchmark_Results.csv', help = 'CSV file the results are appended to')
+    parser.add_argument('--save-ledger', help = 'also write the synthetic ledger to this workbook, without running the benchmark')
+    args = parser.parse_args()
+
+    if args.save_ledger:
+        write_workbook(generate_ledger(args.days, args.shops, args.skus, args.transactions_per_day, seed = args.seed), args.save_ledger)
+    else:
+        results = pd.DataFrame([run_benchmark(args.days, args.shops, args.skus, args.transactions_per_day, args.seed, args.trace_memory) for _ in range(args.repeat)])
+        print(results.T.to_string(header = False))
+        #Results files from before a phase was added are rewritten with the new columns, older runs have none for it
+        if os.path.exists(args.results) and list(pd.read_csv(args.results, nrows = 0).columns) != list(results.columns):
+            results = pd.concat([pd.read_csv(args.results), results], axis = 0, ignore_index = True)[list(results.columns)]
+            results.to_csv(args.results, index = False)
+        else:
+            results.to_csv(args.results, mode = 'a', header = not os.path.exists(args.results), index = False)
@@ -15,999 +15,2127 @@ from datetime import datetime
 import time
 from pprint import pprint
 import math
-import calendar
-
-##Start by defining function to determine which accounts belong in the balance sheet vs P/L
-def label_t_accts(a):
-    if 'Expense' in a:
-        return 'trial_balance'
-    elif 'Unearned' in a:
-        return 'balance_sheet'
-    elif 'Revenue' in a:
-        return 'trial_balance'
-    else:
-        return 'balance_sheet'
-
+import os
+import json
+import hashlib
+import copy
+import argparse
+import tracemalloc
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 #Define inventory levels as High(>60%), Medium(30-60%), Low(1-30%), Empty(0%)
-def inventory_levels_check(b):
-    if b ==1:    #if all slots are empty return Empty
-        return "Empty"
-    elif b>=0.6: #if 60% or more of the slots are empty return Low
-        return "Low"
-    elif b >= 0.3:
-        return "Medium" #if 30% or more of the slots are empty return Medium
-    else:
-        return "High" #if less than 30% of the slots are empty return High
+#b is the share of empty slots, a single value or an array. low and medium are the shares from which the level is Low / Medium, also per value
+def inventory_levels_check(b, low = 0.6, medium = 0.3):
+    b = np.asarray(b, dtype = float)
+    levels = np.select([b == 1,       #if all slots are empty return Empty
+                        b >= low,     #if 60% or more of the slots are empty return Low
+                        b >= medium], #if 30% or more of the slots are empty return Medium
+                       ["Empty", "Low", "Medium"],
+                       "High").astype(object) #if less than 30% of the slots are empty return High
+    return levels if levels.ndim else levels.item()
 
 
 #start up tax exemption scheme https://www.iras.gov.sg/taxes/corporate-income-tax/basics-of-corporate-income-tax/corporate-income-tax-rate-rebates-and-tax-exemption-schemes
+#Both tax functions take a single profit amount or an array of profit amounts
 def start_up_tax_amount(x):
-    if x <= 100000:
-        return x*0.17*0.25*-1 #17% corporate tax rate, 75% exemption for the first 100K of profits
-    elif x <= 200000:
-        return (100000*0.17*0.25 + (x-100000)*0.17*0.5)*-1  #17% corporate tax rate, 75% exemption for the first 100K of profits, 50% exemption for the next 100K
-    else:
-        return (100000*0.17*0.25 + 100000*0.17*0.5 + (x - 200000)*0.17)*-1
+    x = np.asarray(x, dtype = float)
+    return np.select([x <= 100000, x <= 200000],
+                     [x*0.17*0.25*-1, #17% corporate tax rate, 75% exemption for the first 100K of profits
+                      (100000*0.17*0.25 + (x-100000)*0.17*0.5)*-1],  #17% corporate tax rate, 75% exemption for the first 100K of profits, 50% exemption for the next 100K
+                     (100000*0.17*0.25 + 100000*0.17*0.5 + (x - 200000)*0.17)*-1)
 
 #partial tax exemption scheme
 def partial_tax_amount(x):  # this is only used from the fourth Year of Assessment Onwards
-    if x <= 10000:
-        return (x*0.17*0.25)*-1 #17% corporate tax rate, 75% exemption for the first 100K of profits
-    elif x <= 200000:
-        return (10000*0.17*0.25 + (x-10000)*0.17*0.5)*-1  #17% corporate tax rate, 75% exemption for the first 10K of profits, 50% exemption for the next 190K
-    else:
-        return (10000*0.17*0.25 + 190000*0.17*0.5 + (x - 200000)*0.17)*-1
-
-def date_for_tax_transaction(x,y): #x = year type int, y = quarter type int
-    days_in_month = calendar.monthrange(x, y*3)[1]
-    date_return = datetime(x, y*3, days_in_month) #return last day (as date) of the quarter
-    date_input_new = pd.to_datetime(date_input)
-    return date_return if date_return <= date_input_new else date_input_new  #Replace with current date if date is <= input date by user
-
-
-#Convert timestamp to year
-def convert_timestamp(ts, from_pattern, to_pattern):
-    dt = datetime.strptime(ts, from_pattern)
-    return datetime.strftime(dt, to_pattern)
+    x = np.asarray(x, dtype = float)
+    return np.select([x <= 10000, x <= 200000],
+                     [(x*0.17*0.25)*-1, #17% corporate tax rate, 75% exemption for the first 100K of profits
+                      (10000*0.17*0.25 + (x-10000)*0.17*0.5)*-1],  #17% corporate tax rate, 75% exemption for the first 10K of profits, 50% exemption for the next 190K
+                     (10000*0.17*0.25 + 190000*0.17*0.5 + (x - 200000)*0.17)*-1)
+
+
+#Quarterly tax and retained earnings of every quarter of the years given, calculated for all quarters at once
+#profit_loss is the quarterly P&L (profit positive) with the P&L ranking, txns are the transactions used for share issues and dividends
+#Tax of a quarter is the tax on the operating profit of the year to date, less the tax on each earlier quarter of the year on its own
+#Returns the P&L subtotal lines, the Tax Payable and Retained Earnings balance sheet lines, the equity movements and the tax journal entries
+def quarterly_tax(profit_loss, txns, years, date_input):
+    periods = pd.MultiIndex.from_product([years, [1,2,3,4]], names = ['Year','Quarter'])
+
+    tax = pd.DataFrame(index = periods)
+    tax['Gross Profit'] = profit_loss[profit_loss['ranking'] <= 1].groupby(['Year','Quarter'])['Balance'].sum().reindex(periods, fill_value = 0.0)
+    tax['Operating Profit'] = profit_loss[profit_loss['ranking'] <= 3].groupby(['Year','Quarter'])['Balance'].sum().reindex(periods, fill_value = 0.0)
+    tax['Operating Profit YTD'] = tax.groupby(level = 'Year')['Operating Profit'].cumsum()
+
+    tax['Quarter Tax'] = start_up_tax_amount(tax['Operating Profit'])
+    tax['Earlier Quarters Tax'] = tax.groupby(level = 'Year')['Quarter Tax'].cumsum().groupby(level = 'Year').shift(1, fill_value = 0.0)
+    tax['Tax Payable'] = start_up_tax_amount(tax['Operating Profit YTD']) - tax['Earlier Quarters Tax']
+    tax['Profit After Tax'] = tax['Operating Profit'] + start_up_tax_amount(tax['Operating Profit YTD']) - tax['Earlier Quarters Tax']
+
+    #Share capital issued and dividends declared in each quarter
+    txns = txns.assign(Year = txns['Date'].dt.year, Quarter = txns['Date'].dt.quarter)
+    share_issues = txns[txns['Credit'] == 'Share Capital'].groupby(['Year','Quarter'])['Credit_Amount'].sum().reindex(periods, fill_value = 0.0)
+    dividends = txns[txns['Debit'].str.contains('Retained Earnings') & (txns['Credit'] == 'Dividend Payable')].groupby(['Year','Quarter'])['Credit_Amount'].sum().reindex(periods, fill_value = 0.0)
+
+    tax = tax.reset_index()
+
+    #Gross Profit, Operating Profit, Tax Payable and Profit After Tax lines of the P&L
+    profit_loss_lines = tax.melt(id_vars = ['Year','Quarter'], value_vars = ['Gross Profit','Operating Profit','Tax Payable','Profit After Tax'], var_name = 'T_Account_Name', value_name = 'Balance')
+    profit_loss_lines['group'] = 'trial_balance'
+    profit_loss_lines['ranking'] = profit_loss_lines['T_Account_Name'].map({'Gross Profit': 2, 'Operating Profit': 4, 'Tax Payable': 5, 'Profit After Tax': 6})
+
+    #Tax payable and profit after tax go into the balance sheet, 1 line each per quarter
+    balance_sheet_lines = pd.concat([tax[['Year','Quarter']].assign(T_Account_Name = 'Tax Payable', Balance = tax['Tax Payable']),
+                                     tax[['Year','Quarter']].assign(T_Account_Name = 'Retained Earnings', Balance = tax['Profit After Tax']*-1)], axis = 0)
+    balance_sheet_lines = balance_sheet_lines.sort_index(kind = 'mergesort').reset_index(drop = True).assign(group = 'balance_sheet')
+
+    #Movements for the statement of changes to equity, 1 line per quarter for each category
+    stmt_equity = pd.concat([pd.DataFrame({'Category': category, 'Equity Type': equity_type, 'Year': tax['Year'].astype(str), 'Quarter': tax['Quarter'], 'Balance': balance})
+                             for category, equity_type, balance in [('Proceeds from issuance', 'Common Stock', share_issues.to_numpy()),
+                                                                    ('Dividends paid', 'Retained Earnings', dividends.to_numpy()*-1),
+                                                                    ('Profit/Loss', 'Retained Earnings', tax['Profit After Tax'])]], axis = 0)
+    stmt_equity = stmt_equity.sort_index(kind = 'mergesort').reset_index(drop = True)
+
+    #Tax journal entries dated on the last day of each quarter, or the date of report if the quarter has not ended yet
+    quarter_end = pd.to_datetime(dict(year = tax['Year'], month = tax['Quarter']*3, day = 1)) + pd.offsets.MonthEnd(0)
+    tax_amount = start_up_tax_amount(tax['Operating Profit'])*-1
+    tax_txns = pd.DataFrame({'Date': quarter_end.clip(upper = pd.Timestamp(date_input)), 'Debit': 'Tax Expense', 'Debit_Amount': tax_amount, 'Credit_Amount': tax_amount,
+                             'Credit': 'Tax Payable', 'Comments': 'Calculated Tax Payable', 'Quantity': '', 'Ref_Number': '', 'Item_Name': ''})
+
+    return profit_loss_lines, balance_sheet_lines, stmt_equity, tax_txns
 
 
 def return_quarter_int(x):
     return math.ceil(x/3)
 
-def flip_depreciation_expense(x,y):
-    if x == 'Depreciation Expense':
-        return y*-1
-    else:
-        return y
-
-
-'''
-Part 1: Inventory Management and Transaction Calculations
-'''
-
-
-#Retrieve full transaction list and cleaning
-xlsx = pd.ExcelFile('Transactions_Raw.xlsx')
-df = pd.read_excel(xlsx, 'Transaction')
-price_list = pd.read_excel(xlsx, 'Price List')
-shop_space = pd.read_excel(xlsx, 'Shop Space')
-
-df['Date'] = pd.to_datetime(df['Date'])
-df = df.sort_values(by = 'Date', ascending = True).reset_index(drop = True)
-
-'''
-Date Filter from USER
-'''
-date_input = datetime.now()
-date_input = input('Please key in the date of report in YYYY-MM-DD format:')
-
-#Define this year and last year as int
-this_year = int(date_input[:4])
-last_year = int(this_year-1)
-prev_last_year = int(this_year-2)
-
-this_quarter = return_quarter_int(int(date_input[5:7]))
-
-df = df[ df['Date'] <= date_input ]
-
-
-'''
-Continue Set up of transactions before doing up inventory
-'''
-
-#create list of sorted dates
-list_of_dates = df.Date.unique()
 
-#column for shop name
-shop_df = df[ df['Debit'].str[10:14] == 'Shop' ]
-shop_df['Shop'] = shop_df['Debit'].str[10:]
 
-list_of_shops = shop_df.Shop.unique()
+#Price List and Shop Space are updated in full whenever anything changes, so the list in use on a date is the one with the latest Effective_From on or before that date
+def effective_from_as_of(effective_from, dates):
+    effective_dates = np.sort(pd.unique(np.asarray(effective_from, dtype = 'datetime64[ns]')))
+    position = np.searchsorted(effective_dates, np.asarray(dates, dtype = 'datetime64[ns]'), side = 'right') - 1
+    return pd.Series(np.where(position >= 0, effective_dates[np.maximum(position, 0)], np.datetime64('NaT')), dtype = 'datetime64[ns]')
 
-#Part 1: Prepare Inventory List and COGS Expense Calculation
 
-#Filter out Revenue transactions where by Item_Name is blank
+#Look up columns from the Price List / Shop Space in use on each row's 'Date', for all rows in one merge
+def lookup_as_of(table, keys, on, columns, how = 'left'):
+    keys = keys.reset_index(drop = True).assign(Effective_From = effective_from_as_of(table['Effective_From'], keys['Date']))
+    return pd.merge(keys, table[['Effective_From'] + on + columns], how = how, on = ['Effective_From'] + on)
 
-inventory_txns = df[ (df['Credit'] == 'Revenue') | (df['Debit'].str[:9] == 'Inventory') | (df['Credit'].str[:9] == 'Inventory')]
 
-#Let's now create our inventory list in the main warehouse.
+#Convert amounts to integer cents so that prices can be matched exactly, missing amounts become -1
+def to_cents(amount):
+    cents = np.rint(np.asarray(amount, dtype = float) * 100)
+    return np.where(np.isnan(cents), -1, cents).astype(np.int64)
 
-inventory_warehouse = pd.DataFrame()
 
-#Create empty dataframe for each shop's inventory
-inventory_shops =  pd.DataFrame()
+#Index of the Price List on (Effective_From, sale price in cents), used to find out which item is sold from the revenue amount
+#If more than 1 item has the same price on the same list, the price is ambiguous and Item_Name holds all of the items
+def build_price_index(price_list):
+    price_index = pd.DataFrame({'Effective_From': price_list['Effective_From'].to_numpy(), 'Price_Cents': to_cents(price_list['Sale_Price']),
+                                'Item_Name': price_list['Item_Name'].astype(str).to_numpy()})
+    price_index = price_index.groupby(['Effective_From','Price_Cents'])['Item_Name'].agg(['size', ', '.join])
+    return price_index.rename(columns = {'size': 'Matches', 'join': 'Item_Name'})
 
-#Create empty dataframe for inventory alert data
-inventory_data = pd.DataFrame()
 
-#Create empty dataframe for profit loss retained earnings calculations
-profit_loss_total = pd.DataFrame()
+#Find the item sold for every revenue transaction. Returns the item names, and the reason for transactions that cannot be matched to exactly 1 item
+def resolve_sold_items(price_index, dates, amounts):
+    effective_from = effective_from_as_of(price_index.index.get_level_values('Effective_From'), dates)
+    position = price_index.index.get_indexer(pd.MultiIndex.from_arrays([effective_from, to_cents(amounts)]))
 
-stmt_equity = pd.DataFrame()
+    matches = np.where(position >= 0, price_index['Matches'].to_numpy()[position], 0)
+    item_names = np.where(position >= 0, price_index['Item_Name'].to_numpy()[position], None)
 
-stmt_equity_output = pd.DataFrame()
+    exception = np.full(len(position), None, dtype = object)
+    exception[matches == 0] = 'No item with this sale price in the price list'
+    exception[matches > 1] = 'Sale price shared by ' + item_names[matches > 1]
+    return np.where(matches == 1, item_names, None), exception
 
-cashflow_stmt_output = pd.DataFrame()
 
-for date in list_of_dates:
+#Average cost = total value / total quantity, set cost price to 0 if there is no quantity left
+def average_price(value, quantity):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        price = value / quantity
+    return np.where(np.isnan(price), 0, price)
 
-    '''
-    Warehouse Inventory
-    '''
-
-    #Only include transactions for the current date
-    daily_inventory_total = inventory_txns[ inventory_txns['Date'] == date ]
-
-    #Only include inventory warehouse transactions
-    daily_inv_txn = daily_inventory_total[daily_inventory_total['Debit'] == 'Inventory']
-
-    #Update Inventory List first
-    daily_inv_txn = daily_inv_txn.groupby('Item_Name').sum()
-
-    #Calculate average price for current batch
-    daily_inv_txn['Price'] = daily_inv_txn['Credit_Amount'] / daily_inv_txn['Quantity']
-
-    #drop columns
-    daily_inv_txn = daily_inv_txn.drop(columns = ['Debit_Amount','Credit_Amount'])
-
-    #Calculate total inventory cost sitting in warehouse
-    daily_inv_txn['Inventory_Value'] = daily_inv_txn['Quantity']*daily_inv_txn['Price']
-
-
-    inventory_warehouse = pd.concat([inventory_warehouse, daily_inv_txn])
-
-    #Recalculate Cost Price, by the average costing method
-    inventory_warehouse = inventory_warehouse.groupby(['Item_Name']).sum()
-
-
-
-    #Recalculate cost price using average costing method
-    inventory_warehouse['Price'] = inventory_warehouse['Inventory_Value'] / inventory_warehouse['Quantity']
 
-    #IF quantity is 0, set cost price to 0
-    inventory_warehouse['Price'] = inventory_warehouse['Price'].fillna(0)
-
-    #Done with warehouse calculations
-    #Move inventory to other shops, maintain each of their own inventory levels
-    daily_inv_shop_txn = daily_inventory_total[daily_inventory_total['Debit'] != 'Inventory']
-
-    daily_inv_shop_txn = daily_inv_shop_txn[daily_inv_shop_txn['Debit'].str[10:14] == 'Shop' ]
-
-    #Remove any inventory movement txns that are already filled (i.e. code was previously run on it)
-    daily_inv_shop_txn = daily_inv_shop_txn[(daily_inv_shop_txn['Debit_Amount'].isnull() ) | (daily_inv_shop_txn['Credit_Amount'].isnull() )]
-
-
-
-
-
-
-
-
-    '''
-    Calculate individual inventory in each shop
-    '''
+'''
+Input cache: the Transaction, Price List and Shop Space sheets are saved as Parquet files the first time the workbook is read,
+and loaded from there until the workbook is changed
+'''
 
+#Sheets to read from the workbook, and the columns to store as categorical codes
+workbook_sheets = {'Transaction': ['Debit','Credit','Item_Name'], 'Price List': ['Item_Name','Product_Code'], 'Shop Space': ['Item_Name','Shop_Name']}
 
-    #Now we start adding warehouse inventory to individual shop inventory, then recalculate the average price in each shop
 
+#Read the sheets directly from the Excel workbook, then set the column types used by the script
+def read_workbook(path, sheet_names = list(workbook_sheets)):
+    xlsx = pd.ExcelFile(path)
+    sheets = {}
+    for sheet_name in sheet_names:
+        categorical_columns = workbook_sheets[sheet_name]
+        sheet = pd.read_excel(xlsx, sheet_name)
+        for column in sheet.columns:
+            if column in categorical_columns:
+                sheet[column] = sheet[column].astype('category')
+            elif sheet[column].dtype == object:
+                #Free text columns (Comments, Ref_Number) may mix numbers and text, store everything as text
+                sheet[column] = sheet[column].where(sheet[column].isnull(), sheet[column].astype(str))
+        sheets[sheet_name] = sheet
+    return sheets
 
-    #clean daily inventory txns to only include txns involving restocking
 
-    daily_shop_add = daily_inv_shop_txn
-    daily_shop_add['Shop_Name'] = daily_shop_add['Debit'].str[10:]
+#Fingerprint of the workbook contents, used when the modified time changes but the file may not have
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
-    #Clean up dataframe to only include important details
-    daily_shop_add = daily_shop_add.drop(columns = ['Debit','Credit','Debit_Amount','Credit_Amount','Comments','Ref_Number'])
 
-    #Join dataframe with main warehouse dataframe to pull out average price
-    daily_shop_add = pd.merge(daily_shop_add,inventory_warehouse[['Price']] ,right_index = True,left_on = 'Item_Name', how = 'left')
+#Folder for files derived from a workbook (input cache, snapshot), next to the workbook
+def workbook_cache_dir(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.ledger_cache', os.path.splitext(os.path.basename(path))[0])
 
-    #Recalculate total cost price for each line
-    daily_shop_add['Inventory_Value'] = daily_shop_add['Quantity'] * daily_shop_add['Price']
 
-    #drop date column
-    daily_shop_add = daily_shop_add.drop(columns = ['Date'])
+#Load transactions, price list and shop space, from the Parquet cache if the workbook has not changed since it was built
+def load_workbook(path):
+    try:
+        import pyarrow
+    except ImportError:
+        #No Parquet support installed, read the workbook every time
+        sheets = read_workbook(path)
+        return sheets['Transaction'], sheets['Price List'], sheets['Shop Space']
+
+    cache_dir = workbook_cache_dir(path)
+    cache_files = {sheet_name: os.path.join(cache_dir, sheet_name.replace(' ', '_') + '.parquet') for sheet_name in workbook_sheets}
+    source_file = os.path.join(cache_dir, 'source.json')
+
+    stat = os.stat(path)
+    source = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    cached = None
+    if os.path.exists(source_file) and all(os.path.exists(f) for f in cache_files.values()):
+        with open(source_file) as f:
+            cached = json.load(f)
+
+    #Modified time or size changed, only rebuild if the contents changed too
+    if cached is not None and (cached['mtime_ns'], cached['size']) != (source['mtime_ns'], source['size']):
+        source['sha256'] = file_hash(path)
+        if source['sha256'] == cached['sha256']:
+            with open(source_file, 'w') as f:
+                json.dump(source, f)
+        else:
+            cached = None
+
+    if cached is None:
+        sheets = read_workbook(path)
+        os.makedirs(cache_dir, exist_ok = True)
+        for sheet_name, sheet in sheets.items():
+            sheet.to_parquet(cache_files[sheet_name], index = False)
+        source['sha256'] = source.get('sha256') or file_hash(path)
+        with open(source_file, 'w') as f:
+            json.dump(source, f)
+    else:
+        sheets = {sheet_name: pd.read_parquet(cache_file) for sheet_name, cache_file in cache_files.items()}
 
+    return sheets['Transaction'], sheets['Price List'], sheets['Shop Space']
 
-    ###Concatenate to main shop warehouse dataframe
-    inventory_shops = pd.concat([inventory_shops,daily_shop_add])
-    inventory_shops = inventory_shops.reset_index(drop = True)
-    #group by Item_Name and Shop Name, then recalculate average price
-    inventory_shops = inventory_shops.groupby(['Item_Name','Shop_Name']).sum()
 
+'''
+Run diagnostics: named spans around each phase of the close (loading, inventory, COGS, T-Accounts, tax, statements, export).
+Switched off unless enable_diagnostics() is called (--diagnostics), then every span records its wall time, the rows it handled,
+and the change in memory traced by tracemalloc
+'''
 
-    #reset index
-    inventory_shops = inventory_shops.reset_index()
+class RunDiagnostics:
+
+    def __init__(self, trace_memory = True):
+        self.trace_memory = trace_memory
+        self.spans = []
+        self.stack = []
+
+    @contextmanager
+    def span(self, name):
+        if self.trace_memory:
+            self._update_peaks()
+            tracemalloc.reset_peak()
+        record = {'Span': name, 'Depth': len(self.stack), 'Seconds': 0.0, 'Self_Seconds': 0.0, 'Rows': None,
+                  'Memory_Delta_MB': None, 'Peak_MB': None}
+        self.spans.append(record)
+        self.stack.append(record)
+        memory_start = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            record['Seconds'] = elapsed
+            record['Self_Seconds'] += elapsed
+            if self.stack:
+                self.stack[-1]['Self_Seconds'] -= elapsed
+            if self.trace_memory:
+                memory, peak = tracemalloc.get_traced_memory()
+                record['Memory_Delta_MB'] = (memory - memory_start) / 2**20
+                record['Peak_MB'] = max(record['Peak_MB'] or 0, peak / 2**20)
+                self._update_peaks(peak)
+
+    #Peak since the last reset counts for every span still open
+    def _update_peaks(self, peak = None):
+        peak = tracemalloc.get_traced_memory()[1] if peak is None else peak
+        for record in self.stack:
+            record['Peak_MB'] = max(record['Peak_MB'] or 0, peak / 2**20)
+
+    #1 row per span in the order they started, Depth is the number of spans it is inside
+    def to_frame(self):
+        return pd.DataFrame(self.spans, columns = ['Span','Depth','Seconds','Self_Seconds','Rows','Memory_Delta_MB','Peak_MB']).round(4)
+
+    #Total time (without the spans inside), rows and peak memory of each span name
+    def summary(self):
+        return self.to_frame().groupby('Span', sort = False).agg(Calls = ('Span','size'), Seconds = ('Self_Seconds','sum'),
+                                                                         Rows = ('Rows', lambda rows: rows.sum(min_count = 1)), Peak_MB = ('Peak_MB','max')).round(4)
+
+    def write_json(self, path):
+        records = lambda frame: frame.astype(object).where(frame.notnull(), None).to_dict('records')
+        with open(path, 'w') as f:
+            json.dump({'spans': records(self.to_frame()), 'summary': records(self.summary().reset_index())}, f, indent = 1, default = float)
+
+
+#Diagnostics of the current run, None when switched off
+run_diagnostics = None
+
+
+def enable_diagnostics(trace_memory = True):
+    global run_diagnostics
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    run_diagnostics = RunDiagnostics(trace_memory)
+    return run_diagnostics
+
+
+def disable_diagnostics():
+    global run_diagnostics
+    if run_diagnostics is not None and run_diagnostics.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    run_diagnostics = None
+
+
+#Span of a phase, the record it yields takes the number of rows handled ('Rows'). Does nothing if diagnostics are switched off
+@contextmanager
+def span(name):
+    if run_diagnostics is None:
+        yield {}
+    else:
+        with run_diagnostics.span(name) as record:
+            yield record
 
-    #Recalculate average price for inventory in each shop, Quantity and Inventory Value are both summed up, so reverse calculate the new average price
-    inventory_shops['Price'] =  inventory_shops['Inventory_Value'] / inventory_shops['Quantity']
 
-    #change the average price to 0 if number is NaN
-    inventory_shops['Price'] = inventory_shops['Price'].fillna(0)
+'''
+Inventory engine: keeps the running quantity and value of every item in the main warehouse, and of every (item, shop) pair,
+in numpy arrays so that the transactions only need to be walked through once from the earliest to the latest date
+'''
 
+class InventoryState:
+
+    def __init__(self):
+        #Codes for items and shops, the position in the arrays below
+        self.item_codes = {}
+        self.shop_codes = {}
+
+        #Warehouse state, 1 row per item
+        self.warehouse_qty = np.zeros(0)
+        self.warehouse_value = np.zeros(0)
+        self.warehouse_price = np.zeros(0)
+        self.warehouse_seen = np.zeros(0, dtype = bool)
+
+        #Shop state, 1 row per item and 1 column per shop
+        self.shop_qty = np.zeros((0, 0))
+        self.shop_value = np.zeros((0, 0))
+        self.shop_price = np.zeros((0, 0))
+        self.shop_seen = np.zeros((0, 0), dtype = bool)
+
+        #Items / (item, shop) pairs whose quantity was reduced, average price is recalculated at the start of the next day
+        self.warehouse_dirty = np.zeros(0, dtype = np.int64)
+        self.shop_dirty = (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+
+        self.last_date = None
+
+    #Return array codes for item / shop names, registering new names and growing the arrays if needed
+    def item_code(self, names):
+        return self._code(self.item_codes, names)
+
+    def shop_code(self, names):
+        return self._code(self.shop_codes, names)
+
+    def _code(self, codes, names):
+        for name in pd.unique(names):
+            if name not in codes:
+                codes[name] = len(codes)
+        self._grow()
+        return pd.Index(list(codes)).get_indexer(names)
+
+    #Return array codes for names that are already registered, -1 if the name is unknown
+    def lookup_item(self, names):
+        return pd.Index(list(self.item_codes)).get_indexer(names)
+
+    def lookup_shop(self, names):
+        return pd.Index(list(self.shop_codes)).get_indexer(names)
+
+    def _grow(self):
+        n_items, n_shops = len(self.item_codes), len(self.shop_codes)
+        add_items = n_items - len(self.warehouse_qty)
+        add_shops = n_shops - self.shop_qty.shape[1]
+        if add_items == 0 and add_shops == 0:
+            return
+
+        self.warehouse_qty = np.pad(self.warehouse_qty, (0, add_items))
+        self.warehouse_value = np.pad(self.warehouse_value, (0, add_items))
+        self.warehouse_price = np.pad(self.warehouse_price, (0, add_items))
+        self.warehouse_seen = np.pad(self.warehouse_seen, (0, add_items))
+
+        self.shop_qty = np.pad(self.shop_qty, ((0, add_items), (0, add_shops)))
+        self.shop_value = np.pad(self.shop_value, ((0, add_items), (0, add_shops)))
+        self.shop_price = np.pad(self.shop_price, ((0, add_items), (0, add_shops)))
+        self.shop_seen = np.pad(self.shop_seen, ((0, add_items), (0, add_shops)))
+
+    #Inventory in the main warehouse, average cost price per item
+    def warehouse_table(self):
+        item_names = np.array(list(self.item_codes), dtype = object)
+        seen = np.flatnonzero(self.warehouse_seen)
+        return warehouse_inventory_table(pd.DataFrame({'Item_Name': item_names[seen], 'Quantity': self.warehouse_qty[seen],
+                                                       'Price': self.warehouse_price[seen], 'Inventory_Value': self.warehouse_value[seen]}))
+
+    #Inventory in each shop, average cost price per item and shop
+    def shop_table(self):
+        item_names = np.array(list(self.item_codes), dtype = object)
+        shop_names = np.array(list(self.shop_codes), dtype = object)
+        items, shops = np.nonzero(self.shop_seen)
+        return shop_inventory_table(pd.DataFrame({'Item_Name': item_names[items], 'Shop_Name': shop_names[shops], 'Quantity': self.shop_qty[items, shops],
+                                                  'Price': self.shop_price[items, shops], 'Inventory_Value': self.shop_value[items, shops]}))
+
+
+#Inventory Warehouse sheet from the quantity, price and value of every item
+def warehouse_inventory_table(inventory_warehouse):
+    return inventory_warehouse.sort_values('Item_Name').set_index('Item_Name')
+
+
+#Inventory Shop sheet from the quantity, price and value of every (item, shop) pair
+def shop_inventory_table(inventory_shops):
     #Sort by Shop Name to allow user to see inventory easily
-    inventory_shops = inventory_shops.sort_values('Shop_Name')
-
-    '''
-    Deducting inventory from warehouse that is transferred into individual shops
-    '''
-    daily_shop_add_total = daily_shop_add.groupby('Item_Name').sum().reset_index()
-    #Rename columns to make column names unique
-    daily_shop_add_total = daily_shop_add_total.rename(columns = {'Quantity': 'Deduct_Quantity','Item_Name':'Item'} )
-
-
-
-
-    #Join dataframes together, and deduct the quantity from the main warehouse
-    inventory_warehouse = pd.merge(inventory_warehouse, daily_shop_add_total[['Item','Deduct_Quantity']] , left_index = True, right_on = 'Item',how = 'left' )
-
-    #set index as item_name
-    inventory_warehouse = inventory_warehouse.rename(columns = {'Item':'Item_Name'})
-    inventory_warehouse = inventory_warehouse.set_index('Item_Name')
-
-
-
-    #fill na as quantity 0 for deduct quantity
-    inventory_warehouse['Deduct_Quantity'] = inventory_warehouse['Deduct_Quantity'].fillna(0)
-
-    #Update quantity in warehouse
-    inventory_warehouse['Quantity'] = inventory_warehouse['Quantity'] - inventory_warehouse['Deduct_Quantity']
-
-    #Update Inventory Value in warehouse
-    inventory_warehouse['Inventory_Value'] = inventory_warehouse['Quantity'] * inventory_warehouse['Price']
-
-    #Drop Deduct_Quantity column
-    inventory_warehouse = inventory_warehouse.drop(columns = ['Deduct_Quantity'])
-
-    #Recalculate inventory value
-
-    '''
-    Individual Shop Inventory in 1 DataFrame
-    '''
-
-    #Inventory is stocked up. Now we will do the daily COGS Expense calculations and add those transactions into the list
-
-    #First, we take all revenue transactions for the day
-    rev_txns =  daily_inventory_total[daily_inventory_total['Credit'] == 'Revenue']
-    rev_txns['Quantity'] = 1
-
-    #We will filter out the price list we should use
-    daily_price_list = price_list
-    #Find difference in days between price list and current date
-    daily_price_list['Diff_in_Days'] = (date - daily_price_list['Effective_From']).dt.days
-    #filter out price where the diff in days is negative. Only use the price that is positive and has the lowest days diff in the list
-    daily_price_list = daily_price_list[daily_price_list['Diff_in_Days'] >= 0]
-
-    #find minimum number of days, then use it to filter out the price list to the latest available date
-    min_days = daily_price_list['Diff_in_Days'].min()
-
-    daily_price_list = daily_price_list[daily_price_list['Diff_in_Days'] == min_days]
-
-    #Drop item name column from revenue txns, then take it from the price list table
-    rev_txns = rev_txns.drop(columns = 'Item_Name')
-
-    #Now that we have the retail price used, we join this to the main table to determine which items are being sold.
-    rev_txns = pd.merge(rev_txns, daily_price_list[['Item_Name','Sale_Price']], left_on = 'Debit_Amount',right_on = 'Sale_Price')
-
-
-
-
-
-    '''
-    Create COGS Expense Transactions
-    '''
-    #Revenue Transactions are now filled with the items. Now, we will create a new table and calculate the retail price, then we will append this back to the txn table.
-    daily_cogs_exp = rev_txns
-
-    #Left join inventory warehouse to retrieve average cost price
-    daily_cogs_exp = pd.merge(daily_cogs_exp, inventory_shops[['Item_Name','Shop_Name','Price']],  how = 'left',left_on = ['Item_Name','Comments'], right_on = ['Item_Name','Shop_Name'])
-
-    #Change debit and credit tags, as well as debit/credit amounts
-    daily_cogs_exp['Debit'] = 'COGS Expense'
-    daily_cogs_exp['Credit'] = 'Inventory'
-    daily_cogs_exp['Debit_Amount'] = daily_cogs_exp['Quantity'] * daily_cogs_exp['Price']
-    daily_cogs_exp['Credit_Amount'] = daily_cogs_exp['Quantity'] * daily_cogs_exp['Price']
-
-    '''
-    Calculate daily sales and remove quantity from respective shop inventory
-    '''
-    daily_sales = pd.DataFrame()
-
-    daily_sales = daily_cogs_exp[['Date','Quantity','Item_Name','Shop_Name']]
-
-    #Sum up all sales quantity, group by Shop and Item_Name
-
-    daily_sales = daily_sales.groupby(['Item_Name','Shop_Name']).sum().reset_index()
-
-    #Rename columns first before rejoining back to shop inventory
-
-    daily_sales = daily_sales.rename(columns = {'Item_Name':'Item_Name', 'Shop_Name':'Shop_Name','Quantity':'Sale_Quantity'} )
-
-    #Merge daily sales quantity into shop inventory dataframe and deduct balance from inventory
-    inventory_shops = pd.merge(inventory_shops,daily_sales[['Item_Name','Shop_Name','Sale_Quantity']] , how = 'left', left_on = ['Item_Name','Shop_Name'], right_on = ['Item_Name','Shop_Name'] )
-
-    #Remove Quantity Sold from inventory, then drop Sale Quantity column
-    inventory_shops['Sale_Quantity'] = inventory_shops['Sale_Quantity'].fillna(0)
-    inventory_shops['Quantity'] = inventory_shops['Quantity'] - inventory_shops['Sale_Quantity']
-    inventory_shops = inventory_shops.drop(columns = ['Sale_Quantity'] )
-
-    #Recalculate Inventory Value
-    inventory_shops['Inventory_Value'] = inventory_shops['Quantity'] * inventory_shops['Price']
+    inventory_shops = inventory_shops.sort_values(['Item_Name','Shop_Name']).reset_index(drop = True)
+    return inventory_shops.sort_values('Shop_Name')
+
+
+#Quantity, value, average price and seen flag of some cells of the inventory arrays
+def inventory_cells(arrays, cells):
+    return tuple(array[cells] for array in arrays)
+
+
+#Cells whose quantity, value or price changed, or that were seen for the first time, from their state before and after a day
+def changed_cells(before, after):
+    qty, value, price, seen = before
+    return after[3] & ( ~seen | (after[0] != qty) | (after[1] != value) | (after[2] != price) )
+
+
+#Walk through the purchases and transfers to shops date by date and update the warehouse inventory
+#Returns the warehouse cost price of every transfer row, and with record, the (items, quantity, value, price) changed on every day
+def warehouse_pass(state, day_start, day_end, is_purchase, is_transfer, item, quantity, purchase_value, record = False):
+    transfer_price = np.full(len(item), np.nan)
+    changes = []
+    arrays = lambda: (state.warehouse_qty, state.warehouse_value, state.warehouse_price, state.warehouse_seen)
+
+    for start, end in zip(day_start, day_end):
+        rows = start + np.flatnonzero(is_purchase[start:end])
+        transfer_rows = start + np.flatnonzero(is_transfer[start:end])
+        if record:
+            touched = np.unique(np.r_[item[rows], item[transfer_rows], state.warehouse_dirty])
+            before = inventory_cells(arrays(), touched)
+
+        '''
+        Warehouse Inventory
+        '''
+        np.add.at(state.warehouse_qty, item[rows], quantity[rows])
+        np.add.at(state.warehouse_value, item[rows], purchase_value[rows])
+        state.warehouse_seen[item[rows]] = True
+
+        #Recalculate cost price using average costing method, for items bought today or reduced yesterday
+        recalc = np.union1d(item[rows], state.warehouse_dirty)
+        state.warehouse_price[recalc] = average_price(state.warehouse_value[recalc], state.warehouse_qty[recalc])
+
+        #Pull out average price from main warehouse for the transfers to shops
+        add_items = item[transfer_rows]
+        transfer_price[transfer_rows] = np.where(state.warehouse_seen[add_items], state.warehouse_price[add_items], np.nan)
+
+        '''
+        Deducting inventory from warehouse that is transferred into individual shops
+        '''
+        in_warehouse = state.warehouse_seen[add_items]
+        np.subtract.at(state.warehouse_qty, add_items[in_warehouse], quantity[transfer_rows][in_warehouse])
+        state.warehouse_dirty = np.unique(add_items[in_warehouse])
+        state.warehouse_value[state.warehouse_dirty] = state.warehouse_qty[state.warehouse_dirty] * state.warehouse_price[state.warehouse_dirty]
+
+        if record:
+            after = inventory_cells(arrays(), touched)
+            changed = changed_cells(before, after)
+            changes.append((touched[changed],) + tuple(levels[changed] for levels in after[:3]))
+
+    return transfer_price, changes
+
+
+#Walk through the transfers to shops and the sales date by date and update the inventory of the shops (1 column per shop in the arrays)
+#transfers are (day, item, shop, quantity, cost price) and sales (day, item, shop), both in date order, days are numbered from 0 to n_days - 1
+#Only days with transfers or sales, and the day after a sale (when the price of the cells sold is recalculated), change the inventory
+#Returns the updated arrays, the cost price of every sale (NaN if the item was never in the shop),
+#and with record, the (day, item, shop, quantity, value, price) of the cells changed on every day, in (day, item, shop) order
+def shop_pass(shop_qty, shop_value, shop_price, shop_seen, shop_dirty, n_days, transfers, sales, record = False):
+    transfer_day, transfer_items, transfer_shops, transfer_qty, transfer_price = transfers
+    sale_day, sale_items, sale_shops = sales
+    sale_price = np.full(len(sale_day), np.nan)
+    transfer_value = np.nan_to_num(transfer_qty * transfer_price)
+    transfer_bounds = np.searchsorted(transfer_day, np.arange(n_days + 1))
+    sale_bounds = np.searchsorted(sale_day, np.arange(n_days + 1))
+    n_shops = max(shop_qty.shape[1], 1)
+    changes = []
+
+    #The first day also recalculates the cells sold on the last day of the previous call
+    active_days = np.unique(np.r_[transfer_day, sale_day, sale_day + 1, np.zeros(min(len(shop_dirty[0]), 1), dtype = np.int64)])
+    for day in active_days[active_days < n_days]:
+        rows = slice(transfer_bounds[day], transfer_bounds[day + 1])
+        sold = slice(sale_bounds[day], sale_bounds[day + 1])
+        add_items, add_shops = transfer_items[rows], transfer_shops[rows]
+        day_items, day_shops = sale_items[sold], sale_shops[sold]
+        if record:
+            touched = np.unique(np.concatenate([add_items * n_shops + add_shops, shop_dirty[0] * n_shops + shop_dirty[1], day_items * n_shops + day_shops]))
+            cells = (touched // n_shops, touched % n_shops)
+            before = inventory_cells((shop_qty, shop_value, shop_price, shop_seen), cells)
+
+        '''
+        Calculate individual inventory in each shop
+        '''
+        np.add.at(shop_qty, (add_items, add_shops), transfer_qty[rows])
+        np.add.at(shop_value, (add_items, add_shops), transfer_value[rows])
+        shop_seen[add_items, add_shops] = True
+
+        #Recalculate average price for inventory in each shop
+        recalc_items = np.concatenate([add_items, shop_dirty[0]])
+        recalc_shops = np.concatenate([add_shops, shop_dirty[1]])
+        shop_price[recalc_items, recalc_shops] = average_price(shop_value[recalc_items, recalc_shops], shop_qty[recalc_items, recalc_shops])
+
+        '''
+        Create COGS Expense Transactions
+        '''
+        #Retrieve average cost price of the shop the item is sold from
+        in_shop = shop_seen[day_items, day_shops]
+        sale_price[sold][in_shop] = shop_price[day_items[in_shop], day_shops[in_shop]]
+
+        '''
+        Remove quantity sold from respective shop inventory
+        '''
+        np.subtract.at(shop_qty, (day_items[in_shop], day_shops[in_shop]), 1)
+        shop_dirty = (day_items[in_shop], day_shops[in_shop])
+        shop_value[shop_dirty] = shop_qty[shop_dirty] * shop_price[shop_dirty]
+
+        if record:
+            after = inventory_cells((shop_qty, shop_value, shop_price, shop_seen), cells)
+            changed = changed_cells(before, after)
+            changes.append((np.full(changed.sum(), day), cells[0][changed], cells[1][changed]) + tuple(levels[changed] for levels in after[:3]))
+
+    changes = tuple(np.concatenate(column) for column in zip(*changes)) if changes else shop_changes_empty()
+    return shop_qty, shop_value, shop_price, shop_seen, shop_dirty, sale_price, changes
+
+
+#No shop cells changed
+def shop_changes_empty():
+    return (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0), np.zeros(0), np.zeros(0))
+
+
+#Split the changes of shop_pass into the (item, shop, quantity, value, price) of every day, days without changes get empty arrays
+def shop_changes_by_day(changes, n_days):
+    bounds = np.searchsorted(changes[0], np.arange(n_days + 1))
+    return [tuple(column[bounds[day]:bounds[day + 1]] for column in changes[1:]) for day in range(n_days)]
+
+
+#Together, the passes of every shop on its own take 2 to 3 times as long as 1 pass over all shops, as each walks through its own days.
+#Worker processes only pay off with more workers than that, and with enough shops and transfers and sales to cover sending them to the workers
+parallel_min_workers = 4
+parallel_min_shops = 8
+parallel_min_rows = 20000
+
+
+#shop_pass for every shop on its own in a pool of worker processes (e.g. a ProcessPoolExecutor), the results are written back into the state
+#Returns the cost price of every sale and the changed cells, in the same order as shop_pass for all shops at once
+def parallel_shop_pass(state, n_days, transfers, sales, record, pool):
+    n_shops = state.shop_qty.shape[1]
+    sale_price = np.full(len(sales[0]), np.nan)
+    dirty_items, dirty_shops, shop_changes = [], [], []
+
+    futures = []
+    for shop in range(n_shops):
+        #The shop's column of the arrays, with the shop numbered 0
+        rows, sold, dirty = transfers[2] == shop, sales[2] == shop, state.shop_dirty[1] == shop
+        shop_state = [array[:, [shop]] for array in (state.shop_qty, state.shop_value, state.shop_price, state.shop_seen)]
+        shop_transfers = (transfers[0][rows], transfers[1][rows], np.zeros(rows.sum(), dtype = np.int64), transfers[3][rows], transfers[4][rows])
+        shop_sales = (sales[0][sold], sales[1][sold], np.zeros(sold.sum(), dtype = np.int64))
+        shop_dirty = (state.shop_dirty[0][dirty], np.zeros(dirty.sum(), dtype = np.int64))
+        futures.append(pool.submit(shop_pass, *shop_state, shop_dirty, n_days, shop_transfers, shop_sales, record))
+
+    for shop, future in enumerate(futures):
+        shop_qty, shop_value, shop_price, shop_seen, shop_dirty, shop_sale_price, changes = future.result()
+        state.shop_qty[:, shop], state.shop_value[:, shop], state.shop_price[:, shop], state.shop_seen[:, shop] = shop_qty[:, 0], shop_value[:, 0], shop_price[:, 0], shop_seen[:, 0]
+        dirty_items.append(shop_dirty[0])
+        dirty_shops.append(np.full(len(shop_dirty[0]), shop))
+        sale_price[sales[2] == shop] = shop_sale_price
+        shop_changes.append(changes[:2] + (changes[2] + shop,) + changes[3:])
+
+    state.shop_dirty = (np.concatenate(dirty_items), np.concatenate(dirty_shops))
+
+    #Cells in (day, item, shop) order
+    shop_changes = [np.concatenate(column) for column in zip(*shop_changes)]
+    order = np.lexsort((shop_changes[1] * n_shops + shop_changes[2], shop_changes[0]))
+    return sale_price, tuple(column[order] for column in shop_changes)
+
+
+#Walk through the inventory transactions date by date, update warehouse and shop inventory, and create the COGS Expense transactions
+#With an InventoryHistory, the changes of every day are recorded in it. With a pool of worker processes, the shops are processed in parallel in it
+#when there are enough of them. Shop accounts are looked up in the account table (built from the transactions' accounts if not given)
+def run_inventory_engine(inventory_txns, price_index, state = None, history = None, pool = None, accounts = None):
+    if state is None:
+        state = InventoryState()
+
+    txns = inventory_txns.reset_index(drop = True)
+    n_rows = len(txns)
+    if accounts is None:
+        accounts = account_table(pd.concat([txns['Debit'].astype(object), txns['Credit'].astype(object)]))
+    debit, credit = account_codes(txns['Debit'], accounts), account_codes(txns['Credit'], accounts)
+
+    #Warehouse purchases, restocking of shops (inventory movements that are not filled yet) and revenue transactions
+    is_purchase = (txns['Debit'] == 'Inventory').to_numpy()
+    is_transfer = ~is_purchase & account_flag(accounts, 'Is_Shop', debit) & (txns['Debit_Amount'].isnull() | txns['Credit_Amount'].isnull()).to_numpy()
+    is_revenue = account_flag(accounts, 'Is_Revenue', credit)
+
+    #Convert item and shop names into array codes once
+    item = np.full(n_rows, -1)
+    item[is_purchase | is_transfer] = state.item_code(txns['Item_Name'][is_purchase | is_transfer])
+    shop = np.full(n_rows, -1)
+    shop[is_transfer] = state.shop_code(accounts['Shop_Name'].to_numpy()[debit[is_transfer]])
+
+    quantity = np.nan_to_num(txns['Quantity'].to_numpy(dtype = float))
+    purchase_value = np.nan_to_num(txns['Credit_Amount'].to_numpy(dtype = float))
+
+    #Find out which items are sold by matching the sale price with the price list in use on the day of each revenue transaction
+    rev_rows = np.flatnonzero(is_revenue)
+    rev_item_names, rev_exception = resolve_sold_items(price_index, txns['Date'].to_numpy()[rev_rows], txns['Debit_Amount'].to_numpy()[rev_rows])
+    resolved = rev_exception == None
+
+    #Sales that cannot be matched to exactly 1 item are left out of COGS and inventory, and reported instead
+    revenue_exceptions = txns.iloc[rev_rows[~resolved]].assign(Exception = rev_exception[~resolved]).reset_index(drop = True)
+
+    sold_rows = rev_rows[resolved]
+    sold_item_names = rev_item_names[resolved]
+    sold_items = state.lookup_item(sold_item_names)
+    sold_shops = state.lookup_shop(txns['Comments'].to_numpy()[sold_rows])
+    sold_price = np.full(len(sold_rows), np.nan)
+
+    #Start and end row of every date, transactions are sorted by date
+    dates = txns['Date'].to_numpy()
+    day_start = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if n_rows else np.zeros(0, dtype = np.int64)
+    day_end = np.r_[day_start[1:], n_rows]
+    day_of_row = np.searchsorted(day_start, np.arange(n_rows), side = 'right') - 1
+    recording = history is not None
+
+    #Warehouse first: the cost price of every transfer to a shop only depends on the purchases and earlier transfers
+    transfer_price, warehouse_changes = warehouse_pass(state, day_start, day_end, is_purchase, is_transfer, item, quantity, purchase_value, recording)
+
+    #Then the shops, each shop only depends on its own transfers (at the warehouse cost price) and sales
+    rows = np.flatnonzero(is_transfer)
+    transfers = (day_of_row[rows], item[rows], shop[rows], quantity[rows], transfer_price[rows])
+    in_shop = (sold_items >= 0) & (sold_shops >= 0)
+    sales = (day_of_row[sold_rows[in_shop]], sold_items[in_shop], sold_shops[in_shop])
+    if pool is not None and state.shop_qty.shape[1] >= parallel_min_shops and len(transfers[0]) + len(sales[0]) >= parallel_min_rows:
+        sold_price[in_shop], shop_changes = parallel_shop_pass(state, len(day_start), transfers, sales, recording, pool)
+    else:
+        shop_state = (state.shop_qty, state.shop_value, state.shop_price, state.shop_seen, state.shop_dirty)
+        *shop_state, sold_price[in_shop], shop_changes = shop_pass(*shop_state, len(day_start), transfers, sales, recording)
+        state.shop_qty, state.shop_value, state.shop_price, state.shop_seen, state.shop_dirty = shop_state
 
-    #print(inventory_shops)
+    if len(day_start):
+        state.last_date = dates[day_start[-1]]
+    if recording:
+        for day, (start, changes) in enumerate(zip(day_start, shop_changes_by_day(shop_changes, len(day_start)))):
+            history.add_day(dates[start], state, warehouse_changes[day], changes)
 
     '''
-    Append daily COGS Expense into transaction list
+    Daily COGS Expense transactions, to be appended to the full transaction list
     '''
+    with span('cogs') as record:
+        cogs_exp = txns.iloc[sold_rows].copy()
+        cogs_exp['Item_Name'] = sold_item_names
+        cogs_exp['Quantity'] = 1
+        cogs_exp['Debit'] = 'COGS Expense'
+        cogs_exp['Credit'] = 'Inventory'
+        cogs_exp['Debit_Amount'] = sold_price
+        cogs_exp['Credit_Amount'] = cogs_exp['Debit_Amount']
+        record['Rows'] = len(cogs_exp)
 
-    #Prepare daily_cogs_exp table to be appended back into the full transactions list
-    daily_cogs_exp = daily_cogs_exp.drop(columns = ['Sale_Price','Shop_Name','Price'])
-
-    #Append back to raw transaction table
-    df = pd.concat([df,daily_cogs_exp], axis = 0)
-
-
+    return state, cogs_exp.reset_index(drop = True), revenue_exceptions
 
 
+'''
+Inventory history: instead of a copy of the inventory for every day, only the changes are recorded, as 1 event per changed item / (item, shop) pair and day
+with its quantity, average cost price and value after the change. The inventory of any day processed is the latest event of every pair up to that day,
+starting from the checkpoint (inventory of every pair) before it
+'''
 
-    '''
-    Create specific inventory data table, to create an inventory alert and be used for sales analysis
-    '''
+#Shop_Name of events in the main warehouse, shop names always start with 'Shop'
+warehouse_location = 'Warehouse'
+
+history_columns = {'Date': 'datetime64[ns]', 'Item_Name': object, 'Shop_Name': object, 'Quantity': float, 'Price': float, 'Inventory_Value': float}
+
+
+class InventoryHistory:
+
+    def __init__(self, checkpoint_every = 30):
+        #Events in date order, 1 array per column and processed day (joined into 1 array when read)
+        self.columns = {column: [] for column in history_columns}
+        self.n_events = 0
+        self.n_days = 0
+        self.last_date = None
+
+        #Inventory of every pair every checkpoint_every days processed: (date, number of events up to the date, latest event of every pair)
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = []
+
+        self.item_names = np.zeros(0, dtype = object)
+        self.shop_names = np.zeros(0, dtype = object)
+
+    #Record the changes of 1 day: warehouse_changes are the (items, quantity, value, price) and shop_changes the (items, shops, quantity, value, price)
+    #after the day of the items and (item, shop) pairs that changed, with the codes of the state. Days already recorded are skipped
+    def add_day(self, date, state, warehouse_changes, shop_changes):
+        if date <= (self.last_date or pd.Timestamp.min):
+            return
+        items, warehouse_qty, warehouse_value, warehouse_price = warehouse_changes
+        cell_items, cell_shops, shop_qty, shop_value, shop_price = shop_changes
+
+        #Names of the item and shop codes of the state, codes are only added at the end
+        if len(self.item_names) != len(state.item_codes):
+            self.item_names = np.array(list(state.item_codes), dtype = object)
+        if len(self.shop_names) != len(state.shop_codes):
+            self.shop_names = np.array(list(state.shop_codes), dtype = object)
+
+        day = {'Date': np.full(len(items) + len(cell_items), date, dtype = 'datetime64[ns]'),
+               'Item_Name': np.r_[self.item_names[items], self.item_names[cell_items]],
+               'Shop_Name': np.r_[np.full(len(items), warehouse_location, dtype = object), self.shop_names[cell_shops]],
+               'Quantity': np.r_[warehouse_qty, shop_qty], 'Price': np.r_[warehouse_price, shop_price], 'Inventory_Value': np.r_[warehouse_value, shop_value]}
+        for column in history_columns:
+            self.columns[column].append(day[column].astype(history_columns[column]))
+
+        self.n_events += len(day['Date'])
+        self.n_days += 1
+        self.last_date = pd.Timestamp(date)
+        if self.checkpoint_every and self.n_days % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    #Events so far in date order, the arrays of each day are joined into 1 array the first time they are read
+    def _table(self):
+        for column, chunks in self.columns.items():
+            if len(chunks) != 1:
+                self.columns[column] = [np.concatenate(chunks) if chunks else np.zeros(0, dtype = history_columns[column])]
+        return pd.DataFrame({column: chunks[0] for column, chunks in self.columns.items()})
+
+    #Events from the start-th event on, only the arrays of the days needed are joined
+    def events_from(self, start):
+        columns = {}
+        for column, chunks in self.columns.items():
+            tail, end = [], self.n_events
+            for chunk in reversed(chunks):
+                if end <= start:
+                    break
+                tail.append(chunk[max(start - (end - len(chunk)), 0):])
+                end -= len(chunk)
+            columns[column] = np.concatenate(tail[::-1]) if tail else np.zeros(0, dtype = history_columns[column])
+        return pd.DataFrame(columns)
+
+    #All events so far in date order, with the change in quantity and value of every event
+    def events(self):
+        events = self._table()
+        previous = events.groupby(['Item_Name','Shop_Name'], sort = False)[['Quantity','Inventory_Value']].shift()
+        events['Quantity_Change'] = events['Quantity'] - previous['Quantity'].fillna(0)
+        events['Value_Change'] = events['Inventory_Value'] - previous['Inventory_Value'].fillna(0)
+        return events
+
+    #Save the inventory of every pair as of the last date processed, dates after it are then rebuilt from this point
+    def checkpoint(self):
+        if self.checkpoints and self.checkpoints[-1][0] == self.last_date:
+            return
+        self.checkpoints.append((self.last_date, self.n_events, self.levels_as_of(self.last_date)))
+
+    #Latest event of every item / (item, shop) pair on or before a date (Shop_Name is warehouse_location for the main warehouse)
+    #Only dates that were processed by the inventory engine are complete
+    def levels_as_of(self, as_of):
+        as_of = pd.Timestamp(as_of)
+        checkpoint_dates = [date for date, n_events, levels in self.checkpoints]
+        position = np.searchsorted(checkpoint_dates, as_of, side = 'right') - 1 if checkpoint_dates else -1
+
+        events = self._table()
+        end = np.searchsorted(events['Date'].to_numpy(), as_of.to_datetime64(), side = 'right')
+        if position >= 0:
+            date, start, levels = self.checkpoints[position]
+            events = pd.concat([levels, events.iloc[start:end]], axis = 0)
+        else:
+            events = events.iloc[:end]
+        levels = events.drop_duplicates(['Item_Name','Shop_Name'], keep = 'last')
+        return levels.reset_index(drop = True)
+
+    #Inventory Warehouse and Inventory Shop sheets as of a date
+    def warehouse_table(self, as_of):
+        levels = self.levels_as_of(as_of)
+        levels = levels[levels['Shop_Name'] == warehouse_location]
+        return warehouse_inventory_table(levels[['Item_Name','Quantity','Price','Inventory_Value']].reset_index(drop = True))
+
+    def shop_table(self, as_of):
+        levels = self.levels_as_of(as_of)
+        levels = levels[levels['Shop_Name'] != warehouse_location]
+        return shop_inventory_table(levels[['Item_Name','Shop_Name','Quantity','Price','Inventory_Value']].reset_index(drop = True))
+
+    #Quantity (or another column of the events) of every (shop, item) pair over time, 1 column per pair
+    #Dates default to the dates with events, a pair has no value before its first event
+    def stock_over_time(self, items = None, shops = None, dates = None, value = 'Quantity'):
+        events = self.events()
+        if items is not None:
+            events = events[events['Item_Name'].isin(items)]
+        if shops is not None:
+            events = events[events['Shop_Name'].isin(shops)]
+        stock = events.pivot(index = 'Date', columns = ['Shop_Name','Item_Name'], values = value).sort_index(axis = 1).ffill()
+        if dates is not None:
+            stock = stock.reindex(pd.DatetimeIndex(dates), method = 'ffill')
+        return stock
+
+
+#Inventory level thresholds: shares of empty slots from which an item is Low or Medium, for an (item, shop) pair, an item in every shop,
+#every item in a shop, or everything (Item_Name and/or Shop_Name left blank). The most specific row applies, the default is Low 0.6, Medium 0.3
+level_threshold_columns = ['Item_Name','Shop_Name','Low','Medium']
+default_level_thresholds = {'Low': 0.6, 'Medium': 0.3}
+
+
+#Read the thresholds from a CSV file or a workbook with an Inventory Levels sheet, without a file every item uses the default
+def load_level_thresholds(path = None):
+    if path is None:
+        return pd.DataFrame(columns = level_threshold_columns)
+    if path.endswith('.csv'):
+        thresholds = pd.read_csv(path)
+    else:
+        thresholds = pd.read_excel(path, 'Inventory Levels')
 
-    #Filter out the correct shop space that has been allocated to each product
-    #Pull out dataframe with shop space data
-    shop_space_today = shop_space
+    missing = set(level_threshold_columns) - set(thresholds.columns)
+    if missing:
+        raise ValueError('Inventory level thresholds are missing the columns: ' + ', '.join(sorted(missing)))
+    for column in ['Item_Name','Shop_Name']:
+        thresholds[column] = thresholds[column].where(thresholds[column].isnull(), thresholds[column].astype(str).str.strip())
+    invalid = thresholds[ (thresholds['Medium'] > thresholds['Low']) | ~thresholds['Low'].between(0, 1) | ~thresholds['Medium'].between(0, 1) ]
+    if len(invalid):
+        raise ValueError('Inventory level thresholds must be between 0 and 1 with Medium <= Low, check rows: ' + ', '.join(map(str, invalid.index + 2)))
+    return thresholds[level_threshold_columns]
 
-    #Add the date input into the dataframe
-    shop_space_today['date_input'] = date
 
-    #Find the difference in days between shop date and date input
-    shop_space_today['Diff_in_Days'] = (date - shop_space_today['Effective_From']).dt.days
+#Low and Medium thresholds of every (item, shop) pair, from the most specific row of the thresholds
+def resolve_level_thresholds(thresholds, items, shops):
+    keys = pd.DataFrame({'Item_Name': np.asarray(items, dtype = object), 'Shop_Name': np.asarray(shops, dtype = object)})
+    resolved = pd.DataFrame(np.nan, index = keys.index, columns = ['Low','Medium'])
+    given = thresholds[['Item_Name','Shop_Name']].notnull()
 
-    #filter out data where diff in days is negative.
-    shop_space_today = shop_space_today[shop_space_today['Diff_in_Days'] >= 0]
-    #find the minimum number of days, then use it to filter out the shop space to the latest configuaration
-    min_days_shop = shop_space_today['Diff_in_Days'].min()
+    for on in [['Item_Name','Shop_Name'], ['Item_Name'], ['Shop_Name']]:
+        rules = thresholds[ given[on].all(axis = 1) & ~given.drop(columns = on).any(axis = 1) ].drop_duplicates(on, keep = 'last')
+        resolved = resolved.fillna(keys[on].merge(rules[on + ['Low','Medium']], how = 'left', on = on)[['Low','Medium']])
 
-    shop_space_today = shop_space_today[shop_space_today['Diff_in_Days'] == min_days_shop]
+    everything = thresholds[ ~given.any(axis = 1) ]
+    if len(everything):
+        resolved = resolved.fillna(everything[['Low','Medium']].iloc[-1])
+    resolved = resolved.fillna(default_level_thresholds).astype(float)
+    return resolved['Low'].to_numpy(), resolved['Medium'].to_numpy()
 
 
-    #Now, we merge the shop_space data into the current inventory levels. A new table will be created so that further sales analysis can be done.
+#Inventory Stock Check: empty slots and inventory level of every (item, shop) pair, from the Inventory Shop table as of the date of report
+#list_of_dates are the dates with transactions up to the date of report
+#Columns of the Inventory Stock Check sheet, in order
+stock_check_columns = ['Quantity','Price','Inventory_Value','Item_Name','Shop_Name','Slots','date_input','Empty_Slots','%_empty_slots','Level','Updated?']
 
-    inventory_df = inventory_shops
 
-    #Merge shop space data into inventory data, then calculate the number of empty slots and whether any slots are empty
+def inventory_stock_check(inventory_shops, shop_space, list_of_dates, date_input, thresholds = None):
+    #Clean up today's inventory data to figure out which items need restocking (We use the latest available date to see if txns are up to date)
+    #If Date input != date of report you entered, txns are not updated.
+    inventory_list_dates = pd.Timestamp(list_of_dates.max())
 
-    inventory_df = pd.merge(inventory_df,shop_space_today[['Item_Name','Shop_Name','Slots','date_input']], how = 'left',left_on=['Item_Name','Shop_Name'],right_on=['Item_Name','Shop_Name'])
+    #Merge the shop space allocated to each product on the final date of data into inventory data, then calculate the number of empty slots and whether any slots are empty
+    inventory_data_final = lookup_as_of(shop_space, inventory_shops.assign(Date = inventory_list_dates), ['Item_Name','Shop_Name'], ['Slots'])
+    inventory_data_final = inventory_data_final.drop(columns = ['Effective_From']).rename(columns = {'Date': 'date_input'})
 
     #Calculate empty slots in each shop for each item
-    inventory_df['Empty_Slots'] = inventory_df['Slots'] - inventory_df['Quantity']
+    inventory_data_final['Empty_Slots'] = inventory_data_final['Slots'] - inventory_data_final['Quantity']
 
     #Calculate the % of empty slots
-    inventory_df['%_empty_slots'] = (inventory_df['Empty_Slots'] / inventory_df['Slots']).round(2)
+    inventory_data_final['%_empty_slots'] = (inventory_data_final['Empty_Slots'] / inventory_data_final['Slots']).round(2)
 
     #Inventory level check
-    inventory_df['Level'] = inventory_df['%_empty_slots'].apply(lambda x: inventory_levels_check(x))
-
-    inventory_data = pd.concat([inventory_data, inventory_df],axis = 0)
-
-
-
-
-'''
-##End of daily run of calculations
-'''
+    if thresholds is None:
+        thresholds = load_level_thresholds()
+    low, medium = resolve_level_thresholds(thresholds, inventory_data_final['Item_Name'], inventory_data_final['Shop_Name'])
+    inventory_data_final['Level'] = inventory_levels_check(inventory_data_final['%_empty_slots'], low, medium)
 
 
+    #Compare final data date with date of input by user
 
-#Clean up today's inventory data to figure out which items need restocking (We use the latest available date to see if txns are up to date)
-#If Date input != date of report you entered, txns are not updated.
+    date_input_date = datetime.strptime(date_input, '%Y-%m-%d')
 
-#Find all dates where data is available
-inventory_list_dates = inventory_data.date_input.max()
+    inventory_data_final['Updated?'] =  np.where(inventory_data_final['date_input'] >= date_input_date, "UPDATED", "NOT UPDATED" )
+    return inventory_data_final[stock_check_columns]
 
-#Only retrieve the final date of data
-inventory_data_final = inventory_data[inventory_data['date_input'] == inventory_list_dates]
 
+#Inventory level of every (item, shop) pair on every day its quantity changed, or its shop space changed, up to a date
+def inventory_level_history(history, shop_space, thresholds = None, as_of = None):
+    events = history.events()
+    events = events[ (events['Shop_Name'] != warehouse_location) & (events['Date'] <= (pd.Timestamp.max if as_of is None else pd.Timestamp(as_of))) ]
+    stock = events[['Date','Item_Name','Shop_Name','Quantity']]
 
-#Compare final data date with date of input by user
+    #Quantity of the pair on the days its shop space changes, pairs are only checked from their first restocking
+    space_changes = pd.DataFrame({'Date': pd.to_datetime(shop_space['Effective_From']).to_numpy(),
+                                  'Item_Name': shop_space['Item_Name'].astype(object).to_numpy(), 'Shop_Name': shop_space['Shop_Name'].astype(object).to_numpy()})
+    space_changes = space_changes[ (space_changes['Date'] >= stock['Date'].min()) & (space_changes['Date'] <= stock['Date'].max()) ].sort_values('Date', kind = 'mergesort')
+    space_changes = pd.merge_asof(space_changes, stock, on = 'Date', by = ['Item_Name','Shop_Name']).dropna(subset = ['Quantity'])
+    stock = pd.concat([stock, space_changes], axis = 0).drop_duplicates(['Date','Item_Name','Shop_Name'], keep = 'first')
 
-date_input_date = datetime.strptime(date_input, '%Y-%m-%d').date()
+    #Empty slots and level, with the shop space in use on each day
+    levels = lookup_as_of(shop_space, stock, ['Item_Name','Shop_Name'], ['Slots']).drop(columns = ['Effective_From'])
+    levels['Empty_Slots'] = levels['Slots'] - levels['Quantity']
+    levels['%_empty_slots'] = (levels['Empty_Slots'] / levels['Slots']).round(2)
+    if thresholds is None:
+        thresholds = load_level_thresholds()
+    low, medium = resolve_level_thresholds(thresholds, levels['Item_Name'], levels['Shop_Name'])
+    levels['Level'] = inventory_levels_check(levels['%_empty_slots'], low, medium)
+    return levels.sort_values(['Shop_Name','Item_Name','Date'], kind = 'mergesort').reset_index(drop = True)
 
-inventory_data_final['Updated?'] =  inventory_data_final['date_input'].apply(lambda x: "UPDATED" if x >= date_input_date else "NOT UPDATED" )
 
+#Threshold crossings: the days a pair's level changed (e.g. dropped to Low), from inventory_level_history
+#The first day of every pair is a crossing from no level. With levels given, only crossings into these levels are kept
+def level_crossings(level_history, levels = None):
+    previous_level = level_history.groupby(['Shop_Name','Item_Name'], sort = False)['Level'].shift()
+    crossings = level_history.assign(Previous_Level = previous_level)[ level_history['Level'] != previous_level ]
+    if levels is not None:
+        crossings = crossings[crossings['Level'].isin(levels)]
+    return crossings[['Date','Shop_Name','Item_Name','Quantity','Slots','%_empty_slots','Previous_Level','Level']].reset_index(drop = True)
 
 
 '''
-Sort out transaction list by date (for final output)
+Sales aggregates: units sold, revenue, COGS Expense, margin and closing stock of every (shop, item) pair by day, week and month.
+They are updated with the days the ledger processes and saved with the snapshot, so that sales questions read these tables instead of running the close
 '''
 
-df = df.sort_values('Date')
-
-
-
+#Frequency of each aggregate table, Date is the last day of the period
+aggregate_periods = {'Daily': 'D', 'Weekly': 'W', 'Monthly': 'M'}
+aggregate_columns = {'Date': 'datetime64[ns]', 'Shop_Name': object, 'Item_Name': object, 'Units_Sold': float, 'Revenue': float, 'COGS': float,
+                     'Margin': float, 'Closing_Stock': float}
+
+
+class SalesAggregates:
+
+    #Every table is kept as the rows of finished periods, in chunks added as periods finish, and the rows of the periods still open
+    #(from the one of the last date aggregated), which are recalculated with new days. Daily periods are finished once aggregated
+    def __init__(self):
+        self.chunks = {period: [] for period in aggregate_periods}
+        self.open = {period: self._empty() for period in aggregate_periods}
+        #Closing stock of every (shop, item) pair at the end of the finished periods, and every pair seen so far
+        self.closing_stock = {period: self._empty().set_index(['Shop_Name','Item_Name'])['Closing_Stock'] for period in aggregate_periods}
+        self.pairs = self._empty()[['Shop_Name','Item_Name']]
+        #Number of inventory history events already aggregated
+        self.n_events = 0
+        self.last_date = None
+
+    def _empty(self):
+        return pd.DataFrame({column: pd.Series(dtype = dtype) for column, dtype in aggregate_columns.items()})
+
+    #Table of a period so far, the finished chunks are joined into 1 chunk the first time they are read
+    def table(self, period):
+        if len(self.chunks[period]) != 1:
+            self.chunks[period] = [pd.concat(self.chunks[period], axis = 0, ignore_index = True) if self.chunks[period] else self._empty()]
+        if len(self.open[period]) == 0:
+            return self.chunks[period][0]
+        return pd.concat([self.chunks[period][0], self.open[period]], axis = 0, ignore_index = True)
+
+    #Add the days after the last date aggregated: txns and cogs_txns are the transactions and COGS Expense of these days,
+    #history is the inventory history up to the last of these days. Weekly and monthly periods from the one of the last date aggregated are recalculated
+    #Revenue accounts are looked up in the account table, as in run_inventory_engine (built from the transactions' accounts if not given)
+    def update(self, txns, cogs_txns, price_index, history, accounts = None):
+        if self.last_date is not None:
+            txns, cogs_txns = txns[txns['Date'] > self.last_date], cogs_txns[cogs_txns['Date'] > self.last_date]
+        if len(txns) == 0:
+            return
+        first_date, last_date = txns['Date'].min(), txns['Date'].max()
+
+        #Units and revenue of the sales matched to an item, sold from the shop in Comments
+        if accounts is None:
+            accounts = account_table(pd.concat([txns['Debit'].astype(object), txns['Credit'].astype(object)]))
+        revenue = txns[account_flag(accounts, 'Is_Revenue', account_codes(txns['Credit'], accounts))]
+        item_names, exception = resolve_sold_items(price_index, revenue['Date'].to_numpy(), revenue['Debit_Amount'].to_numpy())
+        sales = pd.DataFrame({'Date': revenue['Date'].to_numpy(), 'Shop_Name': revenue['Comments'].to_numpy(), 'Item_Name': item_names,
+                              'Units_Sold': 1, 'Revenue': revenue['Credit_Amount'].to_numpy(dtype = float)})[exception == None]
+        sales = sales.groupby(['Date','Shop_Name','Item_Name'])[['Units_Sold','Revenue']].sum()
+        cogs = cogs_txns.groupby([cogs_txns['Date'], cogs_txns['Comments'].rename('Shop_Name'), cogs_txns['Item_Name'].astype(object)])['Debit_Amount'].sum().rename('COGS')
+
+        #Stock at the end of every day a pair's quantity changed, the other days keep the stock of the day before. Only the new events are read
+        events = history.events_from(self.n_events)
+        self.n_events = history.n_events
+        events = events[ (events['Date'] >= first_date) & (events['Date'] <= last_date) & (events['Shop_Name'] != warehouse_location) ]
+        stock = events.set_index(['Date','Shop_Name','Item_Name'])['Quantity'].rename('Closing_Stock')
+
+        daily = pd.concat([sales.reset_index(), cogs.reset_index(), stock.reset_index()], axis = 0)
+        daily = daily.groupby(['Date','Shop_Name','Item_Name']).sum(min_count = 1).reset_index()
+        daily[['Units_Sold','Revenue','COGS']] = daily[['Units_Sold','Revenue','COGS']].fillna(0)
+        daily['Closing_Stock'] = daily.groupby(['Shop_Name','Item_Name'])['Closing_Stock'].ffill()
+        daily['Closing_Stock'] = daily['Closing_Stock'].fillna(self._closing_stock('Daily', daily))
+        daily['Margin'] = daily['Revenue'] - daily['COGS']
+        self._finish('Daily', daily[list(aggregate_columns)].astype(aggregate_columns))
+        self.pairs = pd.concat([self.pairs, daily[['Shop_Name','Item_Name']]], axis = 0).drop_duplicates()
+
+        #Periods without any transaction between the last date aggregated and the new days are added too
+        from_date = first_date if self.last_date is None else self.last_date
+        self.last_date = last_date
+        for period, freq in aggregate_periods.items():
+            if period != 'Daily':
+                self._roll_up(period, freq, from_date)
+
+    #Add rows of finished periods to a table, and carry the closing stock of their pairs forward
+    def _finish(self, period, rows):
+        if len(rows) == 0:
+            return
+        self.chunks[period].append(rows)
+        last = rows.drop_duplicates(['Shop_Name','Item_Name'], keep = 'last').set_index(['Shop_Name','Item_Name'])['Closing_Stock']
+        closing_stock = pd.concat([self.closing_stock[period], last], axis = 0)
+        self.closing_stock[period] = closing_stock[~closing_stock.index.duplicated(keep = 'last')]
+
+    #Closing stock of each pair in rows at the end of the finished periods of a table
+    def _closing_stock(self, period, rows):
+        return pd.Series(self.closing_stock[period].reindex(pd.MultiIndex.from_frame(rows[['Shop_Name','Item_Name']])).to_numpy(dtype = float), index = rows.index)
+
+    #Daily rows from a date on, read from the last chunks only
+    def _daily_from(self, start):
+        rows = []
+        for chunk in reversed(self.chunks['Daily']):
+            dates = chunk['Date'].to_numpy()
+            rows.append(chunk.iloc[np.searchsorted(dates, start.to_datetime64()):])
+            if len(dates) and dates[0] < start.to_datetime64():
+                break
+        return pd.concat(rows[::-1], axis = 0) if rows else self._empty()
+
+    #Recalculate the periods from the one containing a date, 1 row per pair and period from the pair's first day
+    #Open periods before that one are finished
+    def _roll_up(self, period, freq, from_date):
+        start = pd.Period(from_date, freq).start_time
+        self._finish(period, self.open[period][self.open[period]['Date'] < start])
+
+        rows = self._daily_from(start)
+        period_end = rows['Date'].dt.to_period(freq).dt.end_time.dt.normalize()
+        totals = rows.groupby([period_end, rows['Shop_Name'], rows['Item_Name']]).agg(Units_Sold = ('Units_Sold','sum'), Revenue = ('Revenue','sum'),
+                                                                                       COGS = ('COGS','sum'), Closing_Stock = ('Closing_Stock','last'))
+
+        #Every pair seen so far in every period, pairs without sales or stock changes in a period keep their closing stock
+        period_ends = pd.period_range(start, self.last_date, freq = freq).end_time.normalize()
+        pairs = self.pairs
+        grid = pd.MultiIndex.from_arrays([np.repeat(period_ends, len(pairs)), np.tile(pairs['Shop_Name'].to_numpy(), len(period_ends)),
+                                          np.tile(pairs['Item_Name'].to_numpy(), len(period_ends))], names = ['Date','Shop_Name','Item_Name'])
+        table = totals.reindex(grid).reset_index()
+        table[['Units_Sold','Revenue','COGS']] = table[['Units_Sold','Revenue','COGS']].fillna(0)
+        table['Closing_Stock'] = table.groupby(['Shop_Name','Item_Name'])['Closing_Stock'].ffill()
+        table['Closing_Stock'] = table['Closing_Stock'].fillna(self._closing_stock(period, table))
+
+        #Leave out periods before a pair's first sale or stock
+        started = table.groupby(['Shop_Name','Item_Name'])['Units_Sold'].cumsum().gt(0) | table['Closing_Stock'].notnull()
+        table = table[started].sort_values(['Date','Shop_Name','Item_Name'], kind = 'mergesort')
+        table['Margin'] = table['Revenue'] - table['COGS']
+        self.open[period] = table[list(aggregate_columns)].astype(aggregate_columns).reset_index(drop = True)
+
+    #Write every table to a Parquet file in a folder (Sales_Daily.parquet, ...), with shop and item names as categorical codes
+    def save(self, folder):
+        os.makedirs(folder, exist_ok = True)
+        for period in aggregate_periods:
+            table = self.table(period)
+            table = table.astype({'Shop_Name': 'category', 'Item_Name': 'category', 'Date': 'datetime64[ns]'})
+            table.to_parquet(os.path.join(folder, 'Sales_' + period + '.parquet'), index = False)
 
 
 '''
-Part 2: Create Financial Statements and update Transaction Data with Tax Liabilities
+Accounts: every account name in the ledger gets an integer code (its position in the sorted list of accounts), and its type is parsed from the name once.
+Debit and Credit share these codes, so that filters on the account type are array lookups instead of string operations on every transaction
 '''
 
-#Create Unique List of T-Accounts
-
-first_list = df.Debit.unique()
-second_list = df.Credit.unique()
-
-in_first = set(first_list)
-in_second = set(second_list)
+#Accounts that are only created by the script
+script_accounts = ['COGS Expense','Tax Expense']
 
-resulting_list = list(first_list)
-#Unique List of T-Accounts
-resulting_list.extend(x for x in second_list if x not in resulting_list)
 
-#create list of 0s to create dictionary
-listofzeros = [0] * len(resulting_list)
+#With a chart of accounts, the classification of every account is added, and accounts missing from the chart are rejected
+def account_table(account_names, chart = None):
+    names = sorted(set(pd.Series(account_names).dropna().astype(str)) | set(script_accounts))
+    accounts = pd.DataFrame({'T_Account_Name': names})
+    accounts['Is_Inventory'] = accounts['T_Account_Name'].str[:9] == 'Inventory'
+    accounts['Is_Revenue'] = accounts['T_Account_Name'] == 'Revenue'
+    #Inventory of a shop, e.g. Inventory_Shop A, and the name of the shop
+    accounts['Is_Shop'] = accounts['T_Account_Name'].str[10:14] == 'Shop'
+    accounts['Shop_Name'] = accounts['T_Account_Name'].str[10:].where(accounts['Is_Shop'], None)
+    if chart is not None:
+        accounts = accounts.join(classify_accounts(chart, accounts['T_Account_Name']), on = 'T_Account_Name')
+    return accounts
 
-#Now we will loop through every sorted date from earliest to latest to update the T-Accounts
-#T-accounts at time 0
-t_accts =  dict( zip(resulting_list,listofzeros) )
 
+#Account code of every transaction, -1 if the account is blank
+def account_codes(column, accounts):
+    return pd.Categorical(column, categories = accounts['T_Account_Name']).codes
 
-t_acct_df = pd.DataFrame()
 
-for date in list_of_dates:
-    #filter out transactions to current date
-    new_df = df[df['Date'] == date].reset_index()
-    #make one side negative so that T-Account will balance
-    new_df['Credit_Amount'] = new_df['Credit_Amount'] * -1
-    #calculate daily total debit amounts
-    daily_debit_df = pd.DataFrame( new_df.groupby(['Debit']).sum()['Debit_Amount'] )
-    #calculate daily total credit amounts
-    daily_credit_df = pd.DataFrame( new_df.groupby(['Credit']).sum()['Credit_Amount'] )
-    #place into 1 dataframe for extraction
-    daily_sum = pd.concat([daily_debit_df,daily_credit_df], axis = 0)
-
-    daily_sum['Date'] = date
-    #append to main dataframe
-    t_acct_df = pd.concat([t_acct_df,daily_sum],axis = 0)
-
-#Consolidate T-Accounts, note that the positive/negative signs may not be representative
-t_acct_df.index.name = 'T_Account_Name'
+#Look up an account type (e.g. 'Is_Inventory') for every account code, blank accounts are False
+def account_flag(accounts, flag, codes):
+    return np.r_[accounts[flag].to_numpy(), False][codes]
 
 
 '''
-Prepare T-Accounts for Balance Sheet
+Chart of accounts: the statement, category, P&L ranking and cash flow line of every account, loaded from a CSV file or a 'Chart of Accounts' sheet.
+  Statement        - 'P&L' or 'Balance Sheet'
+  Category         - Asset, Equity or Liabilities for balance sheet accounts, accounts without a category are left out of the balance sheet
+  PL_Ranking       - order in the P&L: 0 revenue, 1 cost of sales, 3 operating expenses
+  Cashflow_Ranking - order in the cash flow statement, for accounts that have their own line
+  Cashflow_Type    - section of the cash flow statement the line is in
+A name ending with * applies to every account starting with the rest of the name, e.g. Inventory_* for the inventory of every shop
 '''
-t_acct_df['Year'] = t_acct_df['Date'].apply(lambda x : x.year)
-t_acct_df['Quarter'] = t_acct_df['Date'].apply(lambda x : x.quarter)
-
-
-#sum all the positive and negative balances
-t_account_balance = t_acct_df.groupby(['T_Account_Name','Year','Quarter']).sum()
-
-
-#add all the credit and debit balance to find the final T-Account balance
-t_account_balance['Balance'] = t_account_balance['Debit_Amount'] + t_account_balance['Credit_Amount']
-#drop debit and credit columns
-t_account_balance = t_account_balance.drop(columns = ['Debit_Amount','Credit_Amount'] ).reset_index()
-
-#now, everything that is positive is debit and everything that is negative is credit
-t_account_balance['group'] = t_account_balance['T_Account_Name'].apply(lambda x: label_t_accts(x) )
 
-#Drop inventory in shops (for presentation)
-t_account_balance = t_account_balance[(t_account_balance['Balance'] != 0) & (t_account_balance['T_Account_Name'].str[:10] != 'Inventory_' )  ]
+#Chart of accounts used when none is given, kept next to this script
+default_chart_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Chart_of_Accounts.csv')
 
 
-'''
-P&L statement calculation for total retained earnings
-'''
-
+def load_chart_of_accounts(path = None):
+    path = path or default_chart_file
+    if path.endswith('.csv'):
+        chart = pd.read_csv(path)
+    else:
+        chart = pd.read_excel(path, 'Chart of Accounts')
 
-###We will start doing the P/L statement now
-profit_loss = t_account_balance[t_account_balance['group'] == 'trial_balance']
+    chart['T_Account_Name'] = chart['T_Account_Name'].astype(str).str.strip()
+    duplicates = chart['T_Account_Name'][chart['T_Account_Name'].duplicated()]
+    if len(duplicates):
+        raise ValueError('Accounts listed more than once in the chart of accounts: ' + ', '.join(duplicates))
+    unknown_statements = set(chart['Statement']) - {'P&L', 'Balance Sheet'}
+    if unknown_statements:
+        raise ValueError('Statement must be P&L or Balance Sheet in the chart of accounts, found: ' + ', '.join(map(str, unknown_statements)))
 
+    #group is the name used by the statements for P&L ('trial_balance') and balance sheet accounts
+    chart['group'] = np.where(chart['Statement'] == 'P&L', 'trial_balance', 'balance_sheet')
+    return chart
 
-#flip balance for P/L
-profit_loss['Balance'] = profit_loss['Balance'] * -1
 
-#Please edit this dictionary to manually set the order of categories in P&L statement and Balance Sheet
-custom_dict = {'Revenue':0,'Ad Revenue':0, 'COGS Expense':1, 'Rent Expense':3, 'Transportation Expense':3,'Depreciation Expense':3}
-custom_dict_balance_sheet = {'Cash': 'Asset', 'Inventory': 'Asset','AR': 'Asset','Equipment':'Asset','Share Capital': 'Equity','Retained Earnings': 'Equity','Tax Payable': 'Liabilities','AP':'Liabilities','Unearned Ad Revenue':'Liabilities'}
+#Classification of each account name from the chart of accounts, accounts that are not in the chart are rejected
+def classify_accounts(chart, account_names):
+    names = pd.Index(account_names)
+    chart_names = chart['T_Account_Name']
 
-#sort by dictionary above
-profit_loss['ranking'] = profit_loss['T_Account_Name'].map(custom_dict)
-profit_loss = profit_loss.sort_values(by = 'T_Account_Name', key = lambda x: x.map(custom_dict))
+    #Exact names first, then the longest matching prefix
+    position = pd.Index(chart_names).get_indexer(names)
+    prefix_rows = sorted(np.flatnonzero(chart_names.str.endswith('*')), key = lambda row: -len(chart_names.iloc[row]))
+    for row in prefix_rows:
+        position = np.where((position < 0) & names.str.startswith(chart_names.iloc[row][:-1]), row, position)
 
+    if (position < 0).any():
+        raise ValueError('Accounts missing from the chart of accounts: ' + ', '.join(names[position < 0]))
 
-#balance sheet dataframe
-balance_sheet = t_account_balance[t_account_balance['group'] == 'balance_sheet']
+    classification = chart.iloc[position].drop(columns = ['T_Account_Name'])
+    classification.index = names
+    return classification
 
 
 '''
-Calculate tax payable each year and append back to profit_loss table to find total tax payable and total retained earnings
+T-Accounts: the debit and credit legs of all transactions are stacked into one table and summed by account and date in one go
 '''
-list_of_dates_str =  [str(x)[:10] for x in list_of_dates]
-list_of_years = [convert_timestamp( ts, '%Y-%m-%d','%Y') for ts in list_of_dates_str]
-unique_years = set(list_of_years)
-unique_years = sorted(unique_years)
-unique_quarters = [1,2,3,4]
-balance_sheet_output = pd.DataFrame()
-
-
-from datetime import datetime
-
-#Loop between year and quarter to calculate amount for each period
-for year in unique_years:
-
-    #Create / Reset current year total profits and tax payable, to be used to calculate quarterly tax amounts
-
-    tax_payable_year_sum = 0
-    operating_profit_year_sum = 0
-
-
-    for quarter in unique_quarters:
-
-        profit_loss_yearly = profit_loss[profit_loss['Year'].astype(str) == year.strip() ]
-
-        profit_loss_yearly = profit_loss_yearly[profit_loss_yearly['Quarter'] == quarter ]
-
-        year_final_day = int(datetime.strptime(year, '%Y').date().year)
-        year_final_day = datetime(year_final_day, 12, 31)
-
-        #calculate rolling year operating profit and tax payable, to append back to main dataframes
-        operating_profit_year_sum = operating_profit_year_sum + np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] )
-
-        #Prepare transaction dataframe for export to statement of changes in equity
-        txn_per_quarter = df
-        txn_per_quarter['Year'] = txn_per_quarter['Date'].apply(lambda x : x.year).astype(int)
-        txn_per_quarter['Quarter'] = txn_per_quarter['Date'].apply(lambda x : x.quarter).astype(int)
-
-        #Filter out current year and quarter data
-        txn_per_quarter = txn_per_quarter[(txn_per_quarter['Year'] == int(year)) & (txn_per_quarter['Quarter'] == int(quarter))]
-
-        #Filter out share capital or dividend related transactions only
-        txn_per_quarter = txn_per_quarter[ (txn_per_quarter['Debit'].str.contains('Retained Earnings') & (txn_per_quarter['Credit'].str.contains('Dividend') )) | (txn_per_quarter['Credit'].str.contains('Share Capital') ) ]
-
-
-        #Add Gross Profit and Operating Profit Before Tax into trial_balance
-        gross_profit = {'T_Account_Name': 'Gross Profit','Quarter': quarter , 'Balance': np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 1]['Balance'] ), 'group':'trial_balance', 'ranking': 2}
-        operating_profit = {'T_Account_Name': 'Operating Profit','Quarter': quarter , 'Balance': np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ), 'group':'trial_balance', 'ranking': 4}
-        tax_payable = {'T_Account_Name': 'Tax Payable','Quarter': quarter , 'Balance': start_up_tax_amount(operating_profit_year_sum) - tax_payable_year_sum, 'group':'trial_balance', 'ranking': 5}
-        profit_after_tax = {'T_Account_Name': 'Profit After Tax','Quarter': quarter , 'Balance': np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) + start_up_tax_amount(operating_profit_year_sum) - tax_payable_year_sum, 'group':'trial_balance', 'ranking': 6}
-        tax_payable_balance_sheet = {'T_Account_Name': 'Tax Payable','Year':year,'Quarter': quarter ,'Balance': start_up_tax_amount(operating_profit_year_sum) - tax_payable_year_sum, 'group': 'balance_sheet'}
-        profit_after_tax_balance_sheet = {'T_Account_Name': 'Retained Earnings','Year':year,'Quarter': quarter , 'Balance': (np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) + start_up_tax_amount(operating_profit_year_sum) - tax_payable_year_sum)*-1, 'group':'balance_sheet'}
-
-        tax_payable_transaction = {'Date': date_for_tax_transaction(int(year),quarter) ,'Debit':'Tax Expense', 'Debit_Amount': start_up_tax_amount(np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) ) *-1,
-                                    'Credit_Amount': start_up_tax_amount(np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) ) *-1,'Credit':'Tax Payable', 'Comments':'Calculated Tax Payable','Quantity':'' , 'Ref_Number':'','Item_Name':''}
-
-
-        #Update dictionary to be added to statement to changes in equity
-        proceeds_from_issuing_shares = {'Category':'Proceeds from issuance','Equity Type':'Common Stock','Year':year,'Quarter':quarter,'Balance':np.sum(txn_per_quarter[txn_per_quarter['Credit']=='Share Capital']['Credit_Amount']) }
-        dividend_payouts = {'Category':'Dividends paid','Equity Type':'Retained Earnings','Year':year,'Quarter':quarter,'Balance': (np.sum(txn_per_quarter[txn_per_quarter['Credit']=='Dividend Payable']['Credit_Amount']))*-1 }
-        retained_earnings = {'Category':'Profit/Loss','Equity Type':'Retained Earnings','Year':year,'Quarter':quarter,'Balance': (np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) + start_up_tax_amount(operating_profit_year_sum) - tax_payable_year_sum) }
-
-        #Calculate total tax payable for the year so far, to be used for the next quarter
-        tax_payable_year_sum = tax_payable_year_sum + start_up_tax_amount(np.sum( profit_loss_yearly[profit_loss_yearly['ranking'] <= 3]['Balance'] ) )
-
-
-        #Append tax payable yearly back to P&L
-        profit_loss_yearly = profit_loss_yearly.append([gross_profit,operating_profit,tax_payable,profit_after_tax], ignore_index = True).sort_values('ranking')
-        profit_loss_yearly['Year'] = int(year)
-
 
-        #Append yearly profit loss back into main dataframe
-        profit_loss_total = pd.concat([profit_loss_total,profit_loss_yearly],axis = 0)
-
-        #append tax payable into balance sheet
-        balance_sheet = balance_sheet.append([tax_payable_balance_sheet,profit_after_tax_balance_sheet], ignore_index = True )
-
-        #Append tax payable to txns
-        df = df.append([tax_payable_transaction],ignore_index = True)
-
-        #Append equity movements into stmt of changes to equity
-        temp_stmt_equity_df = pd.DataFrame([proceeds_from_issuing_shares,dividend_payouts,retained_earnings])
-        stmt_equity = pd.concat([stmt_equity,temp_stmt_equity_df], axis = 0,ignore_index = True)
+#Daily total debit (positive) and credit (negative) amounts of every T-Account
+#With the account table, legs are summed by account code and the names are looked up after
+def build_t_accounts(txns, accounts = None):
+    if accounts is not None:
+        dates = txns['Date'].to_numpy()
+        legs = pd.DataFrame({'Date': np.r_[dates, dates],
+                             'Account': np.r_[account_codes(txns['Debit'], accounts), account_codes(txns['Credit'], accounts)],
+                             'Debit_Amount': np.r_[txns['Debit_Amount'].to_numpy(dtype = float), np.zeros(len(txns))],
+                             'Credit_Amount': np.r_[np.zeros(len(txns)), txns['Credit_Amount'].to_numpy(dtype = float) * -1]})
+        t_acct_df = legs[legs['Account'] >= 0].groupby(['Date','Account']).sum().reset_index()
+        t_acct_df.insert(1, 'T_Account_Name', accounts['T_Account_Name'].to_numpy()[t_acct_df.pop('Account').to_numpy()])
+        return t_acct_df
+
+    debit_leg = pd.DataFrame({'Date': txns['Date'], 'T_Account_Name': txns['Debit'].astype(object), 'Debit_Amount': txns['Debit_Amount'], 'Credit_Amount': 0.0})
+    credit_leg = pd.DataFrame({'Date': txns['Date'], 'T_Account_Name': txns['Credit'].astype(object), 'Debit_Amount': 0.0, 'Credit_Amount': txns['Credit_Amount'] * -1})
+    t_acct_df = pd.concat([debit_leg, credit_leg], axis = 0, ignore_index = True)
+    return t_acct_df.groupby(['Date','T_Account_Name']).sum().reset_index()
+
+
+#Trial balance: total debit, credit and balance of every T-Account per period, periods can be any of 'Date', 'Year' and 'Quarter'
+def trial_balance(t_acct_df, periods = ['Year','Quarter']):
+    t_accts = t_acct_df.assign(Year = t_acct_df['Date'].dt.year, Quarter = t_acct_df['Date'].dt.quarter)
+    t_account_balance = t_accts.groupby(['T_Account_Name'] + periods)[['Debit_Amount','Credit_Amount']].sum()
+    #add all the credit and debit balance to find the final T-Account balance
+    t_account_balance['Balance'] = t_account_balance['Debit_Amount'] + t_account_balance['Credit_Amount']
+    return t_account_balance.reset_index()
+
+
+#Running balances: the cumulative total of every key (e.g. T-Account) over the (year, quarter) periods in order.
+#The balance as of a quarter, or the change between 2 quarters, is then a lookup instead of a filter and group by over all quarters
+class RunningBalance:
+
+    def __init__(self, frame, key = 'T_Account_Name', value = 'Balance'):
+        period = frame['Year'].astype(int).to_numpy()*4 + frame['Quarter'].astype(int).to_numpy() - 1
+        self.periods = np.unique(period)
+        key_codes, keys = pd.factorize(frame[key], sort = True)
+        self.keys = pd.Index(keys, name = key)
+
+        #Column 0 is before the first period, column i is the total up to and including the i-th period
+        column = np.searchsorted(self.periods, period) + 1
+        totals = np.zeros((len(self.keys), len(self.periods) + 1))
+        rows = np.zeros((len(self.keys), len(self.periods) + 1), dtype = np.int64)
+        np.add.at(totals, (key_codes, column), frame[value].to_numpy(dtype = float))
+        np.add.at(rows, (key_codes, column), 1)
+        self.balance = np.cumsum(totals, axis = 1)
+        self.rows = np.cumsum(rows, axis = 1)
+
+    #Column of the running totals as of the end of a quarter
+    def _column(self, year, quarter = 4):
+        return np.searchsorted(self.periods, year*4 + quarter - 1, side = 'right')
+
+    #Balance of every key as of the end of a quarter, for keys with any amount up to then
+    def as_of(self, year, quarter = 4):
+        column = self._column(year, quarter)
+        present = self.rows[:, column] > 0
+        return pd.Series(self.balance[present, column], index = self.keys[present])
+
+    #Change in balance of every key between the end of 1 quarter and the end of a later quarter, for keys with any amount in between
+    def change(self, from_year, from_quarter, to_year, to_quarter):
+        start, end = self._column(from_year, from_quarter), self._column(to_year, to_quarter)
+        present = self.rows[:, end] > self.rows[:, start]
+        return pd.Series(self.balance[present, end] - self.balance[present, start], index = self.keys[present])
+
+    #Change in balance of every key over a year
+    def year_total(self, year):
+        return self.change(year - 1, 4, year, 4)
 
 
 '''
-Calculate and prepare P&L and B/S output for report generation
+Ledger: transactions of 1 workbook kept in memory, so that statements can be generated for many report dates without reading the workbook again.
+Inventory, COGS Expense and T-Accounts are only processed up to the report dates asked for, and kept for the next report date.
+They are also saved to a snapshot file, so that the next run only needs to process the transactions after the last report date.
 '''
 
+#Increase when the contents of the snapshot change, older snapshots are then ignored
+snapshot_version = 6
+
+#Fingerprint of a list of transactions (independent of row order), used to check that transactions already in the snapshot were not edited
+def transactions_fingerprint(txns):
+    return int(pd.util.hash_pandas_object(txns, index = False).sum())
+
+
+#Transactions sorted by date once, with the row range of every date and the rows posted to every debit and credit account
+#Date range and account queries are then slices and lookups instead of a scan of every transaction
+class TransactionStore:
+
+    def __init__(self, transactions):
+        self.transactions = transactions.sort_values('Date', kind = 'mergesort').reset_index(drop = True)
+
+        #Row of the first transaction of every date, and the number of rows at the end
+        dates = self.transactions['Date'].to_numpy()
+        day_start = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if len(dates) else np.zeros(0, dtype = np.int64)
+        self.dates = dates[day_start]
+        self.date_offsets = np.r_[day_start, len(dates)]
+
+        #Rows of every account on each side, in date order
+        self.debit_postings = self.transactions.groupby('Debit', observed = True, sort = False).indices
+        self.credit_postings = self.transactions.groupby('Credit', observed = True, sort = False).indices
+
+    #Number of rows dated on or before a date
+    def end_row(self, as_of):
+        return self.date_offsets[np.searchsorted(self.dates, pd.Timestamp(as_of).to_datetime64(), side = 'right')]
+
+    #Transactions on or before a date
+    def until(self, as_of):
+        return self.transactions.iloc[:self.end_row(as_of)]
+
+    #Transactions after the start date, up to and including the end date
+    def between(self, start, end):
+        return self.transactions.iloc[self.end_row(start):self.end_row(end)]
+
+    #Sorted list of dates with transactions, up to a date
+    def dates_until(self, as_of):
+        return self.dates[:np.searchsorted(self.dates, pd.Timestamp(as_of).to_datetime64(), side = 'right')]
+
+    #Rows posted to a debit account and a credit account (None for any account), in date order
+    def rows(self, debit = None, credit = None):
+        empty = np.zeros(0, dtype = np.int64)
+        if debit is None and credit is None:
+            return np.arange(len(self.transactions))
+        if debit is None:
+            return self.credit_postings.get(credit, empty)
+        if credit is None:
+            return self.debit_postings.get(debit, empty)
+        return np.intersect1d(self.debit_postings.get(debit, empty), self.credit_postings.get(credit, empty), assume_unique = True)
+
+    #Transactions posted to any of the (debit, credit) account pairs, on or before a date, in date order
+    def postings(self, pairs, as_of = None):
+        rows = np.unique(np.concatenate([self.rows(debit, credit) for debit, credit in pairs])) if pairs else np.zeros(0, dtype = np.int64)
+        if as_of is not None:
+            rows = rows[rows < self.end_row(as_of)]
+        return self.transactions.iloc[rows]
+
+
+#Transactions that change inventory: warehouse purchases, restocking of shops and sales
+def inventory_transactions(df, accounts = None):
+    if accounts is not None:
+        debit, credit = account_codes(df['Debit'], accounts), account_codes(df['Credit'], accounts)
+        return df[ account_flag(accounts, 'Is_Revenue', credit) | account_flag(accounts, 'Is_Inventory', debit) | account_flag(accounts, 'Is_Inventory', credit) ]
+    return df[ (df['Credit'] == 'Revenue') | (df['Debit'].str[:9] == 'Inventory') | (df['Credit'].str[:9] == 'Inventory')]
+
+
+class Ledger:
+
+    def __init__(self, workbook, use_snapshot = True, chart_file = None, levels_file = None):
+        self.workbook = workbook
+        self.level_thresholds = load_level_thresholds(levels_file)
+
+        with span('load') as record:
+            #Retrieve full transaction list and cleaning
+            df, self.price_list, self.shop_space = load_workbook(workbook)
+            df['Date'] = pd.to_datetime(df['Date'])
+
+            #Classify every account from the chart of accounts (default: Chart_of_Accounts.csv next to this script)
+            #Debit and Credit share 1 list of accounts, so that their categorical codes are the account codes
+            self.accounts = account_table(pd.concat([df['Debit'].astype(object), df['Credit'].astype(object)]), load_chart_of_accounts(chart_file))
+            for column in ['Debit','Credit']:
+                df[column] = pd.Categorical(df[column].astype(object), categories = self.accounts['T_Account_Name'])
+
+            self.store = TransactionStore(df)
+            self.transactions = self.store.transactions
+            #Row hashes for fingerprint, built on first use. The service calls fingerprint from several threads
+            self._fingerprint_index = None
+            self._fingerprint_lock = threading.Lock()
+            self.price_index = build_price_index(self.price_list)
+            record['Rows'] = len(self.transactions)
+
+        #Inventory state as of every date processed so far, nothing is in inventory before the first transaction
+        self.inventory_states = {pd.Timestamp.min: InventoryState()}
+        #Changes in inventory, and sales aggregates, of every day up to the latest date processed
+        self.history = InventoryHistory()
+        self.sales = SalesAggregates()
+        #Number of processes for the inventory of the shops, None to process all shops in this process. The pool is started once and reused
+        self.inventory_workers = None
+        self._inventory_pool = None
+
+        #COGS Expense transactions, revenue exceptions and daily T-Account totals up to the latest date processed
+        self.processed_date = pd.Timestamp.min
+        self.cogs_txns = self.transactions.iloc[:0]
+        self.revenue_exceptions = self.transactions.iloc[:0].assign(Exception = None)
+        self.t_acct_df = build_t_accounts(self.transactions.iloc[:0], self.accounts)
+
+        #Snapshot of the previous run, kept together with the input cache of the workbook
+        self.snapshot_file = os.path.join(workbook_cache_dir(workbook), 'Ledger_Snapshot.pkl') if use_snapshot else None
+        if self.snapshot_file is not None:
+            self.load_snapshot()
+
+    #Inventory as of a date, continuing from the latest inventory state before that date
+    #COGS Expense and T-Accounts are added for transactions that were not processed for an earlier report date
+    def inventory_as_of(self, as_of):
+        as_of = pd.Timestamp(as_of)
+        if as_of in self.inventory_states:
+            return self.inventory_states[as_of]
+
+        start = max(date for date in self.inventory_states if date <= as_of)
+        txns = self.store.between(start, as_of)
+        with span('inventory') as record:
+            inventory_txns = inventory_transactions(txns, self.accounts)
+            #Days after the latest date processed continue the inventory history
+            history = self.history if as_of > self.processed_date else None
+            inventory_state, cogs_txns, revenue_exceptions = run_inventory_engine(inventory_txns, self.price_index, copy.deepcopy(self.inventory_states[start]), history,
+                                                                                     self.inventory_pool(), self.accounts)
+            record['Rows'] = len(inventory_txns)
+        self.inventory_states[as_of] = inventory_state
+
+        if as_of > self.processed_date:
+            new_txns = txns[txns['Date'] > self.processed_date]
+            cogs_txns = cogs_txns[cogs_txns['Date'] > self.processed_date]
+            revenue_exceptions = revenue_exceptions[revenue_exceptions['Date'] > self.processed_date]
+
+            with span('sales_aggregates') as record:
+                self.sales.update(new_txns, cogs_txns, self.price_index, self.history, self.accounts)
+                record['Rows'] = len(new_txns)
+
+            self.cogs_txns = pd.concat([self.cogs_txns, cogs_txns], axis = 0, ignore_index = True)
+            self.revenue_exceptions = pd.concat([self.revenue_exceptions, revenue_exceptions], axis = 0, ignore_index = True)
+            #Sum up daily debit and credit amounts of every T-Account (credit side negative so that T-Account will balance)
+            with span('t_accounts') as record:
+                self.t_acct_df = pd.concat([self.t_acct_df, build_t_accounts(pd.concat([new_txns, cogs_txns], axis = 0), self.accounts)], axis = 0, ignore_index = True)
+                record['Rows'] = len(new_txns) + len(cogs_txns)
+            self.processed_date = as_of
+
+            if self.snapshot_file is not None:
+                self.save_snapshot()
+
+        return inventory_state
+
+    #Pool of worker processes for the inventory of the shops, started the first time it is needed. None for fewer than parallel_min_workers,
+    #as processing the shops in this process is faster then
+    def inventory_pool(self):
+        if self.inventory_workers is None or self.inventory_workers < parallel_min_workers:
+            return None
+        if self._inventory_pool is None:
+            self._inventory_pool = ProcessPoolExecutor(max_workers = self.inventory_workers)
+        return self._inventory_pool
+
+    #Stop the worker processes of the ledger, if any
+    def close(self):
+        if self._inventory_pool is not None:
+            self._inventory_pool.shutdown()
+            self._inventory_pool = None
+
+    #Daily, Weekly or Monthly sales aggregates of every (shop, item) pair up to a date (default: the latest date processed)
+    def sales_aggregates(self, period = 'Monthly', as_of = None):
+        if as_of is not None and pd.Timestamp(as_of) > self.processed_date:
+            self.inventory_as_of(as_of)
+        table = self.sales.table(period)
+        return table if as_of is None else table[table['Date'] <= pd.Timestamp(as_of)]
+
+    #Fingerprint of everything the statements as of a date depend on: the transactions up to the date, price list, shop space,
+    #classification of the accounts used up to the date and inventory level thresholds. Transactions added after the date leave it unchanged,
+    #also when they use new accounts
+    def fingerprint(self, as_of):
+        prefix_hashes, reference_fingerprint, account_first_row = self._fingerprint_index or self._build_fingerprint_index()
+        end = self.store.end_row(as_of)
+        #Classification of the accounts used up to the date only, accounts first used later do not change it
+        accounts = transactions_fingerprint(self.accounts[account_first_row < end])
+        return hashlib.sha256(repr((int(prefix_hashes[end]), int(end), reference_fingerprint, accounts)).encode()).hexdigest()
+
+    #Built once by the first caller, the others wait for it. The index is only published once complete
+    def _build_fingerprint_index(self):
+        with self._fingerprint_lock:
+            if self._fingerprint_index is not None:
+                return self._fingerprint_index
+
+            #Running total of the row fingerprints in date order, the fingerprint of the rows up to a date is 1 lookup
+            prefix_hashes = np.r_[np.uint64(0), np.cumsum(pd.util.hash_pandas_object(self.transactions, index = False).to_numpy(), dtype = np.uint64)]
+            reference_fingerprint = [transactions_fingerprint(table) for table in [self.price_list, self.shop_space, self.level_thresholds]]
+            #First row posted to every account, accounts created by the script are used from the start
+            n_rows = len(self.transactions)
+            codes = np.r_[account_codes(self.transactions['Debit'], self.accounts), account_codes(self.transactions['Credit'], self.accounts)]
+            rows = np.r_[np.arange(n_rows), np.arange(n_rows)][codes >= 0]
+            account_first_row = np.full(len(self.accounts), n_rows)
+            np.minimum.at(account_first_row, codes[codes >= 0], rows)
+            account_first_row[self.accounts['T_Account_Name'].isin(script_accounts).to_numpy()] = -1
+
+            self._fingerprint_index = (prefix_hashes, reference_fingerprint, account_first_row)
+            return self._fingerprint_index
+
+    #Sorted list of dates with transactions, up to a date
+    def transaction_dates(self, as_of):
+        return self.store.dates_until(as_of)
+
+    #Inventory Stock Check as of any date, rebuilt from the inventory history without running the inventory engine again
+    def stock_check(self, as_of):
+        as_of = pd.Timestamp(as_of)
+        if as_of > self.processed_date:
+            self.inventory_as_of(as_of)
+        list_of_dates = self.transaction_dates(as_of)
+        if len(list_of_dates) == 0:
+            raise ValueError('No transactions on or before ' + str(as_of.date()))
+        return inventory_stock_check(self.history.shop_table(as_of), self.shop_space, list_of_dates, as_of.strftime('%Y-%m-%d'), self.level_thresholds)
+
+    #Threshold crossings of every (item, shop) pair up to a date, e.g. levels = ['Low','Empty'] for the days items dropped to Low or Empty
+    def inventory_alerts(self, as_of, levels = None):
+        as_of = pd.Timestamp(as_of)
+        if as_of > self.processed_date:
+            self.inventory_as_of(as_of)
+        return level_crossings(inventory_level_history(self.history, self.shop_space, self.level_thresholds, as_of), levels)
+
+    #Trial balance per year and quarter as of each of the dates, from the daily T-Account totals processed so far
+    #Quarters that ended before a date are complete and added up once for all dates, only each date's own quarter is added up to the date
+    def trial_balances(self, dates):
+        dates = [pd.Timestamp(date) for date in dates]
+        with span('t_accounts') as record:
+            t_acct_df = self.t_acct_df[ self.t_acct_df['Date'] <= max(dates) ]
+            quarters = trial_balance(t_acct_df)
+            quarter_start = pd.to_datetime(dict(year = quarters['Year'], month = quarters['Quarter']*3 - 2, day = 1))
+
+            balances = {}
+            for date in dates:
+                date_quarter_start = date.to_period('Q').start_time
+                current_quarter = trial_balance(t_acct_df[ (t_acct_df['Date'] >= date_quarter_start) & (t_acct_df['Date'] <= date) ])
+                balances[date] = pd.concat([quarters[quarter_start < date_quarter_start], current_quarter], axis = 0).sort_values(['T_Account_Name','Year','Quarter']).reset_index(drop = True)
+            record['Rows'] = len(t_acct_df)
+        return balances
+
+    #Continue from the snapshot if the transactions it covers are unchanged
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+
+        snapshot = pd.read_pickle(self.snapshot_file)
+        if snapshot.get('version') != snapshot_version:
+            return
+        if snapshot['fingerprint'] != transactions_fingerprint(self.store.until(snapshot['date'])):
+            return
+
+        inventory_state = InventoryState()
+        inventory_state.__dict__.update(snapshot['inventory_state'])
+        self.inventory_states[snapshot['date']] = inventory_state
+        self.history.__dict__.update(snapshot['inventory_history'])
+        self.sales.__dict__.update(snapshot['sales_aggregates'])
+
+        self.processed_date = snapshot['date']
+        self.cogs_txns = snapshot['cogs_txns']
+        self.revenue_exceptions = snapshot['revenue_exceptions']
+        self.t_acct_df = snapshot['t_acct_df']
+
+    def save_snapshot(self):
+        fingerprint = transactions_fingerprint(self.store.until(self.processed_date))
+        snapshot = {'version': snapshot_version, 'date': self.processed_date, 'fingerprint': fingerprint,
+                    'inventory_state': vars(self.inventory_states[self.processed_date]), 'inventory_history': vars(self.history), 'sales_aggregates': vars(self.sales),
+                    'cogs_txns': self.cogs_txns, 'revenue_exceptions': self.revenue_exceptions, 't_acct_df': self.t_acct_df}
+        os.makedirs(os.path.dirname(self.snapshot_file), exist_ok = True)
+        pd.to_pickle(snapshot, self.snapshot_file)
+
+        #Sales aggregates are also saved as Parquet files for dashboards (requires pyarrow)
+        try:
+            import pyarrow
+        except ImportError:
+            return
+        self.sales.save(os.path.dirname(self.snapshot_file))
 
 
-#Filter out this year and previous year data only for P&L generation
-profit_loss_this_year = profit_loss_total[ (profit_loss_total['Year'] == this_year) | (profit_loss_total['Year'] == last_year) ]
-
-#P&L generation for YTD data - Only take data up to current quarter only
-profit_loss_year_output = profit_loss_this_year[profit_loss_this_year['Quarter'] <= this_quarter ]
-
-#Group P&L by T_Account_Name,year,group, and ranking (drop quarter data)
-profit_loss_year_output = profit_loss_year_output.groupby(['T_Account_Name','Year','group','ranking']).sum().reset_index()
-
-profit_loss_year_output = profit_loss_year_output.sort_values('ranking')
-
-#Pivot table to show this year and last year's P&L as column data instead
-profit_loss_year_output = profit_loss_year_output.pivot_table('Balance',['T_Account_Name','ranking'],'Year').reset_index().sort_values('ranking')
-
-#Round all numbers to 2 dp
-profit_loss_year_output = profit_loss_year_output.round(2)
-
-#Balance Sheet - Loop by last year and this year, then calculate QTD numbers accordingly.
-for year in [last_year,this_year]:
-
-    #For every year, take all T Accounts for the whole year, and for the current year, take T Accounts only till the particular quarter
-    balance_sheet_year_loop = balance_sheet[  (balance_sheet['Year'].astype(int) < year) | ( (balance_sheet['Year'].astype(int) == year) & (balance_sheet['Quarter'] <= this_quarter))    ]
-
-    #Add grouping to balance sheet
-    balance_sheet_year_loop['asset_grouping'] = balance_sheet_year_loop['T_Account_Name'].map(custom_dict_balance_sheet)
-
-
-    balance_sheet_year_loop = balance_sheet_year_loop.groupby(['T_Account_Name','asset_grouping']).sum().reset_index()
-
-    #Convert negative credit values to positive values
-    balance_sheet_year_loop['Balance'] = np.where( balance_sheet_year_loop['asset_grouping'] == 'Equity', abs(balance_sheet_year_loop['Balance']), balance_sheet_year_loop['Balance'])
-    balance_sheet_year_loop['Balance'] = np.where( balance_sheet_year_loop['asset_grouping'] == 'Liabilities', abs(balance_sheet_year_loop['Balance']), balance_sheet_year_loop['Balance'])
-
-    #Add grouping to balance sheet
-    balance_sheet_year_loop['asset_grouping'] = balance_sheet_year_loop['T_Account_Name'].map(custom_dict_balance_sheet)
-
-    #Sum up asset accounts on the balance sheet
-    balance_sheet_year_loop = balance_sheet_year_loop.groupby(['T_Account_Name','asset_grouping']).sum().reset_index()
-
-
-    #Add year to balance sheet df to be used to pivot later
-    balance_sheet_year_loop['Year'] = year
-
-    #sort balance sheet by asset grouping Asset--> Equity --> Liabilities
-    balance_sheet_year_loop = balance_sheet_year_loop.sort_values('asset_grouping')
-
-    balance_sheet_output = pd.concat([balance_sheet_output,balance_sheet_year_loop])
+'''
+Cash flow statement: lines for cash paid or received come from the cash transactions of each (debit, credit) account pair in cashflow_pairs,
+operating profit, non-cash expenses, changes in working capital and cash balances come from the running balances.
+Ranking and section of lines that are accounts come from the chart of accounts, the others from cashflow_lines
+'''
 
+#Cash transactions that have their own line in the cash flow statement, and the sign of their amount in the statement
+cashflow_pairs = pd.DataFrame([('Equipment', 'Cash', 'Equipment', -1),
+                               ('Cash', 'Equipment Payable', 'Equipment', -1),
+                               ('Tax Payable', 'Cash', 'Taxes Paid', -1),
+                               ('Dividend Payable', 'Cash', 'Dividends paid', -1),
+                               ('Cash', 'Share Capital', 'Proceeds from issuance', 1)], columns = ['Debit','Credit','Line','Sign'])
+
+#Ranking and section of cash flow lines that are not accounts in the chart of accounts
+cashflow_lines = pd.DataFrame([('Operating Profit', 1, 'Cashflow from Operations'),
+                               ('Taxes Paid', 4, 'Cashflow from Operations'),
+                               ('Dividends paid', 8, 'Cashflow from Financing'),
+                               ('Proceeds from issuance', 8, 'Cashflow from Financing')], columns = ['Line','Cashflow_Ranking','Cashflow_Type']).set_index('Line')
+
+#Subtotal of each section, and its ranking
+cashflow_subtotals = [('Cashflow from Operations', 'Net cash from operations', 5), ('Cashflow from Investing', 'Net cash from investing', 7),
+                      ('Cashflow from Financing', 'Net cash from financing', 9)]
+
+
+#Cash flow statement for last year and this year up to the date of report
+#balance_sheet_balances and profit_loss_balances are the running balances of the balance sheet accounts and P&L lines
+def cash_flow_statement(store, balance_sheet_balances, profit_loss_balances, chart, date_input):
+    this_year = int(date_input[:4])
+    last_year = this_year - 1
+    years = [last_year, this_year]
+
+    working_capital_accounts = chart.index[(chart['group'] == 'balance_sheet') & (chart['Cashflow_Type'] == 'Cashflow from Operations')]
+    non_cash_expenses = chart.index[(chart['group'] == 'trial_balance') & chart['Cashflow_Type'].notnull()]
+
+    #Operating profit, non-cash expenses (added back) and changes in working capital (sign flipped) of each year
+    lines = []
+    for year in years:
+        profit_loss_year = profit_loss_balances.year_total(year)
+        profit_loss_year = profit_loss_year[(profit_loss_year.index == 'Operating Profit') | profit_loss_year.index.isin(non_cash_expenses)]
+        lines.append(pd.DataFrame({'Category': profit_loss_year.index, 'Year': year,
+                                   'Balance': np.where(profit_loss_year.index.isin(non_cash_expenses), profit_loss_year*-1, profit_loss_year)}))
+
+        working_capital_year = balance_sheet_balances.year_total(year)
+        working_capital_year = working_capital_year[working_capital_year.index.isin(working_capital_accounts)]
+        lines.append(pd.DataFrame({'Category': working_capital_year.index, 'Year': year, 'Balance': working_capital_year.to_numpy()*-1}))
+
+    #Cash paid or received for every account pair in cashflow_pairs, for both years in 1 group by
+    cash_txns = store.postings(list(zip(cashflow_pairs['Debit'], cashflow_pairs['Credit'])), date_input)
+    cash_txns = pd.DataFrame({'Debit': cash_txns['Debit'].astype(object), 'Credit': cash_txns['Credit'].astype(object),
+                              'Year': cash_txns['Date'].dt.year, 'Amount': cash_txns['Debit_Amount']})
+    cash_txns = cash_txns[cash_txns['Year'].isin(years)].merge(cashflow_pairs, on = ['Debit','Credit'])
+    cash_txns['Balance'] = cash_txns['Amount'] * cash_txns['Sign']
+    lines.append(cash_txns.groupby(['Line','Year'], as_index = False)['Balance'].sum().rename(columns = {'Line': 'Category'}))
+
+    #1 row per line, 1 column per year
+    cashflow_stmt_output = pd.concat(lines, axis = 0, ignore_index = True).pivot_table('Balance', ['Category'], 'Year').reindex(columns = years).reset_index()
+    line_info = pd.concat([chart.loc[chart['Cashflow_Type'].notnull(), ['Cashflow_Ranking','Cashflow_Type']], cashflow_lines], axis = 0)
+    cashflow_stmt_output['ranking'] = cashflow_stmt_output['Category'].map(line_info['Cashflow_Ranking'])
+    cashflow_stmt_output['Cashflow type'] = cashflow_stmt_output['Category'].map(line_info['Cashflow_Type'])
+    cashflow_stmt_output['ranking_main'] = 1
+
+    #Subtotal of each section and net change in cash
+    subtotals = [{'Category': name, **cashflow_stmt_output.loc[cashflow_stmt_output['Cashflow type'] == section, years].sum(), 'ranking': ranking, 'ranking_main': 1, 'Cashflow type': section}
+                 for section, name, ranking in cashflow_subtotals]
+    subtotals.append({'Category': 'Net change in cash and cash equivalents', **cashflow_stmt_output[years].sum(), 'ranking': 10, 'ranking_main': 1, 'Cashflow type': 'Net change in cash'})
+
+    #Cash at the beginning and end of each year, the end of this year is the date of report
+    cash = {year: balance_sheet_balances.as_of(year).get('Cash', 0.0) for year in [last_year - 1] + years}
+    subtotals.append({'Category': 'Cash and cash equivalents, beginning of period', last_year: cash[last_year - 1], this_year: cash[last_year], 'ranking': 11, 'ranking_main': 2, 'Cashflow type': 'Final Reconciliation'})
+    subtotals.append({'Category': 'Cash and cash equivalents, end of period', last_year: cash[last_year], this_year: cash[this_year], 'ranking': 12, 'ranking_main': 2, 'Cashflow type': 'Final Reconciliation'})
+
+    cashflow_stmt_output = pd.concat([cashflow_stmt_output, pd.DataFrame(subtotals)], axis = 0, ignore_index = True)
+    cashflow_stmt_output = cashflow_stmt_output.sort_values(['ranking_main','ranking','Category']).fillna(0)
+
+    #Only keep relevant data columns for export, rounded to 2 decimal places
+    return cashflow_stmt_output[['Category',last_year,this_year,'Cashflow type']].round(2)
 
 
-    #prepare stmt of changes to equity output
-    stmt_equity_year = stmt_equity.groupby(['Category','Equity Type','Year']).sum().reset_index()
+'''
+Part 1: Inventory Management and Transaction Calculations
+'''
 
+#Share issues and dividends declared, (debit, credit) account pairs read from the ledger's postings (None for any account)
+equity_pairs = [(None, 'Share Capital'), (None, 'Dividend Payable')]
 
-    stmt_equity_output = pd.concat([stmt_equity_output,stmt_equity_year],axis = 0, ignore_index = True)
-    #end of loop
+#Every (debit, credit) account pair whose transactions generate_statements reads directly, the rest only through the T-Accounts
+statement_pairs = equity_pairs + list(zip(cashflow_pairs['Debit'], cashflow_pairs['Credit']))
 
-'''New loop to calculate line items required for cash flow statement
-Data required from the past 3 years: P&L for the full year, AP/AR balances, Depreciation Expense, Operating Profit, Taxes Paid, Dividends Paid, Purchase or Disposal of equipment'''
 
+#Generate all statements as of the date of report from a loaded ledger, returns 1 dataframe per output sheet
+#t_account_balance is the trial balance as of the date if already calculated (see generate_statement_series)
+def generate_statements(ledger, as_of, t_account_balance = None):
+    '''
+    Date Filter from USER
+    '''
+    date_input = pd.Timestamp(as_of).strftime('%Y-%m-%d')
 
-for year in [prev_last_year,last_year,this_year]:
+    #Define this year and last year as int
+    this_year = int(date_input[:4])
+    last_year = int(this_year-1)
+    prev_last_year = int(this_year-2)
 
-    '''Add Cash Balances into cash flow statement'''
-    #Calculate balance sheet numbers to be used for cash flow statement
-    balance_sheet_cash = balance_sheet[ (balance_sheet['Year'].astype(int) <= year) & (balance_sheet['T_Account_Name'] == 'Cash')]
+    this_quarter = return_quarter_int(int(date_input[5:7]))
 
-    #Sum up all cash transactions to find the ending cash balance for the year
-    balance_sheet_cash = balance_sheet_cash.groupby(['T_Account_Name']).sum().reset_index()
+    df = ledger.store.until(date_input)
 
-    #Add year and label Category name
-    balance_sheet_cash['Year'] = year
+    #create list of sorted dates
+    list_of_dates = ledger.transaction_dates(date_input)
+    if len(list_of_dates) == 0:
+        raise ValueError('No transactions on or before ' + date_input)
 
-    #Return actual day for cash if it's on the date of report, else return 'end of year'
-    if year == this_year:
-        balance_sheet_cash['T_Account_Name'] = balance_sheet_cash['T_Account_Name'] + ' as of ' + str(date_input)
 
-    else:
-        balance_sheet_cash['T_Account_Name'] = balance_sheet_cash['T_Account_Name'] + ' as of end of ' + str(year)
+    #Part 1: Prepare Inventory List and COGS Expense Calculation
 
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,balance_sheet_cash],axis = 0,ignore_index = True)
+    #Find warehouse and shop inventory, and the COGS Expense of every sale, as of the date of report
+    #Only transactions that were not processed for an earlier report (or the snapshot) are run through
+    inventory_state = ledger.inventory_as_of(date_input)
+    daily_cogs_exp = ledger.cogs_txns[ ledger.cogs_txns['Date'] <= date_input ]
+    revenue_exceptions = ledger.revenue_exceptions[ ledger.revenue_exceptions['Date'] <= date_input ]
 
-    '''Add operating profit before tax and depreciation expense'''
-    #Find out total operating profit for current year, as well as depreciation expense (if any)
-    profit_loss_cashflow = profit_loss_total[(profit_loss_total['T_Account_Name'] == 'Operating Profit') & (profit_loss_total['Year'].astype(int) == year )
-                            | (profit_loss_total['T_Account_Name'] == 'Depreciation Expense') & (profit_loss_total['Year'].astype(int) == year ) ]
+    inventory_warehouse = inventory_state.warehouse_table()
+    inventory_shops = inventory_state.shop_table()
 
-    #only include past 2 years of profits into cash flow statement
-    profit_loss_cashflow = profit_loss_cashflow[profit_loss_cashflow['Year'] >= last_year ]
+    #Append COGS Expense back to raw transaction table
+    df = pd.concat([df,daily_cogs_exp], axis = 0)
 
-    try:
-        profit_loss_cashflow['Balance'] = profit_loss_cashflow.apply(lambda x : flip_depreciation_expense( x['T_Account_Name'], x['Balance'] ), axis = 1 )
-    except:
-        pass
-    #Sum up year/ year to date profits
-    profit_loss_cashflow = profit_loss_cashflow.groupby(['T_Account_Name','Year']).sum().reset_index()
 
-    #Prepare dataframe properly for export to main cash flow dataframe
-    profit_loss_cashflow = profit_loss_cashflow[['T_Account_Name','Quarter','Balance','Year']]
+    '''
+    Create specific inventory data table, to create an inventory alert and be used for sales analysis
+    '''
 
-    #Export to cashflow dataframe
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,profit_loss_cashflow],axis = 0,ignore_index= True)
+    with span('stock_check') as record:
+        inventory_data_final = inventory_stock_check(inventory_shops, ledger.shop_space, list_of_dates, date_input, ledger.level_thresholds)
+        record['Rows'] = len(inventory_data_final)
 
 
-    '''Add changes in operating assets and liabilities into cashflow statement'''
-    #Include AR, AP, Unearned Revenue, Inventory only
-    balance_sheet_cashflow = balance_sheet[(balance_sheet['T_Account_Name'] == 'AR') | (balance_sheet['T_Account_Name'] == 'AP')
-                                            | (balance_sheet['T_Account_Name'] == 'Inventory') | (balance_sheet['T_Account_Name'] == 'Unearned Ad Revenue')]
 
-    #Filter out current year data
-    balance_sheet_cashflow = balance_sheet_cashflow[balance_sheet_cashflow['Year'] == year]
+    '''
+    Sort out transaction list by date (for final output)
+    '''
 
-    #Only include past 2 years of data only
-    balance_sheet_cashflow = balance_sheet_cashflow[balance_sheet_cashflow['Year'] >= last_year]
+    df = df.sort_values('Date')
 
-    #Sum up changes to various t accounts
-    balance_sheet_cashflow = balance_sheet_cashflow.groupby(['T_Account_Name','Year']).sum().reset_index()
 
-    #Flip sign on balances to account for cash flow
-    balance_sheet_cashflow['Balance'] = balance_sheet_cashflow['Balance']*-1
 
-    #Rearrange columns, then append back to cash flow output dataframe
-    balance_sheet_cashflow = balance_sheet_cashflow[['T_Account_Name','Quarter','Balance','Year']]
 
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,balance_sheet_cashflow],axis = 0,ignore_index= True)
 
-    '''Add any equipment that are purchased in the year into CFI'''
-    #Go back to transaction data to retrieve actual cash payments for equipment
-    equipment_cashflow = df[ ( (df['Debit'] == 'Equipment') & (df['Credit'] == 'Cash') ) | ( (df['Credit'] == 'Equipment Payable') & (df['Debit'] == 'Cash') ) ]
+    '''
+    Part 2: Create Financial Statements and update Transaction Data with Tax Liabilities
+    '''
 
-    #Only include past 2 years of data only
-    equipment_cashflow = equipment_cashflow[equipment_cashflow['Year'] >= last_year]
-    #Filter out current year data only
-    equipment_cashflow = equipment_cashflow[equipment_cashflow['Year'] == year]
+    '''
+    Prepare T-Accounts for Balance Sheet
+    '''
+    #sum all the positive and negative balances per year and quarter, note that the positive/negative signs may not be representative
+    if t_account_balance is None:
+        t_account_balance = ledger.trial_balances([date_input])[pd.Timestamp(date_input)]
 
-    #Change name to Equipment
-    equipment_cashflow['T_Account_Name'] = 'Equipment'
-    equipment_cashflow['Balance'] = equipment_cashflow['Debit_Amount']*-1
-    #Filter out data if equipment purchase was not in last 2 years
-    equipment_cashflow = equipment_cashflow.groupby(['T_Account_Name','Year']).sum().reset_index()
+    #drop debit and credit columns
+    t_account_balance = t_account_balance.drop(columns = ['Debit_Amount','Credit_Amount'] )
 
-    #equipment_cashflow['Year'] = year
+    #Classification of every account from the chart of accounts
+    chart = ledger.accounts.set_index('T_Account_Name')
 
-    #Only keep relevant columns before joining back to cashflow statement
-    equipment_cashflow = equipment_cashflow[['T_Account_Name','Quarter','Balance','Year']]
+    #now, everything that is positive is debit and everything that is negative is credit
+    t_account_balance['group'] = t_account_balance['T_Account_Name'].map(chart['group'])
 
-    #Join equipment payment back to dataframe
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,equipment_cashflow], axis = 0, ignore_index=True)
+    #Drop balance sheet accounts without a category, e.g. inventory in shops (for presentation)
+    t_account_balance = t_account_balance[(t_account_balance['Balance'] != 0) & ( (t_account_balance['group'] != 'balance_sheet') | t_account_balance['T_Account_Name'].map(chart['Category']).notnull() ) ]
 
-    '''Add taxes that are actually paid out'''
-    #Filter out transactions for taxes that are actually paid out in cash
-    taxes_cashflow = df[ (df['Debit'] == 'Tax Payable') & (df['Credit'] == 'Cash') ]
 
-    #Only include past 2 years of data only
-    taxes_cashflow = taxes_cashflow[taxes_cashflow['Year'] >= last_year]
+    '''
+    P&L statement calculation for total retained earnings
+    '''
 
-    #Filer out current year data only
-    taxes_cashflow  = taxes_cashflow[taxes_cashflow['Year'] == year]
 
-    #Change name to Taxes Paid
-    taxes_cashflow['T_Account_Name'] = 'Taxes Paid'
-    taxes_cashflow['Balance'] = taxes_cashflow['Debit_Amount']*-1
+    with span('profit_loss') as record:
+        ###We will start doing the P/L statement now
+        profit_loss = t_account_balance[t_account_balance['group'] == 'trial_balance']
 
-    #Sum up all taxes paid
-    taxes_cashflow = taxes_cashflow.groupby(['T_Account_Name','Year']).sum().reset_index()
 
-    #taxes_cashflow['Year']
-    #Only keep relevant columns before joining back to cashflow statement
-    taxes_cashflow = taxes_cashflow[['T_Account_Name','Quarter','Balance','Year']]
+        #flip balance for P/L
+        profit_loss['Balance'] = profit_loss['Balance'] * -1
 
-    #Join taxes paid back to dataframe
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,taxes_cashflow], axis = 0, ignore_index=True)
+        #Order of categories in P&L statement and Balance Sheet come from the chart of accounts
+        profit_loss['ranking'] = profit_loss['T_Account_Name'].map(chart['PL_Ranking'])
+        profit_loss = profit_loss.sort_values('ranking')
 
-    '''Add Share capital issuance and deduct dividends actually paid'''
-    #Filter out dividends actually paid out and cash raised from issuing shares
-    equity_cashflow = df[ ( (df['Debit'] == 'Dividend Payable') & (df['Credit'] == 'Cash') ) | ( (df['Debit'] == 'Cash') & (df['Credit'] == 'Share Capital') ) ]
 
-    #Only include past 2 years of data only
-    equity_cashflow = equity_cashflow[equity_cashflow['Year'] >= last_year]
+        #balance sheet dataframe
+        balance_sheet = t_account_balance[t_account_balance['group'] == 'balance_sheet']
+        record['Rows'] = len(profit_loss)
 
-    #Filer out current year data only
-    equity_cashflow  = equity_cashflow[equity_cashflow['Year'] == year]
 
-    equity_cashflow['T_Account_Name'] = ""
-    equity_cashflow['Balance'] = 0
+    '''
+    Calculate tax payable each year and append back to profit_loss table to find total tax payable and total retained earnings
+    '''
+    unique_years = sorted(pd.DatetimeIndex(list_of_dates).year.unique())
+    balance_sheet_output = pd.DataFrame()
 
-    #Change share capital to proceeds from issuance, dividend to dividends paid
-    try:
-        #Rename T Account
-        equity_cashflow['T_Account_Name'] = equity_cashflow.apply(lambda x: 'Dividends paid' if x['Debit'] == 'Dividend Payable' else ( 'Proceeds from issuance' if x['Credit'] == 'Share Capital' else '' ), axis = 1 )
+    with span('tax') as record:
+        #Share issues and dividends declared are looked up from the credit account postings
+        equity_txns = ledger.store.postings(equity_pairs, date_input)
+        profit_loss_tax, balance_sheet_tax, stmt_equity, tax_txns = quarterly_tax(profit_loss, equity_txns, unique_years, date_input)
 
-        #Change balance to negative for dividends
-        equity_cashflow['Balance'] = equity_cashflow.apply(lambda x: x['Debit_Amount']*-1 if x['Debit'] == 'Dividend Payable' else x['Debit_Amount'], axis =1 )
+        #Add Gross Profit, Operating Profit, Tax Payable and Profit After Tax into the P&L of each quarter
+        profit_loss_total = pd.concat([profit_loss, profit_loss_tax], axis = 0).sort_values(['Year','Quarter','ranking'], kind = 'mergesort')
 
-    except:
-        pass
+        #append tax payable and profit after tax into balance sheet
+        balance_sheet = pd.concat([balance_sheet, balance_sheet_tax], axis = 0, ignore_index = True)
 
-    #Sum up all equity transactions with cash flows
-    equity_cashflow = equity_cashflow.groupby(['T_Account_Name','Year']).sum().reset_index()
-    #Only keep relevant columns before joining back to cashflow statement
-    equity_cashflow = equity_cashflow[['T_Account_Name','Quarter','Balance','Year']]
-    #Join equity transactions back to dataframe
-    cashflow_stmt_output = pd.concat([cashflow_stmt_output,equity_cashflow], axis = 0, ignore_index=True)
+        #Append tax payable to txns, and label every transaction with its year and quarter
+        df = pd.concat([df, tax_txns], axis = 0, ignore_index = True)
+        df['Year'] = df['Date'].dt.year
+        df['Quarter'] = df['Date'].dt.quarter
+        record['Rows'] = len(tax_txns)
 
 
+    '''
+    Calculate and prepare P&L and B/S output for report generation
+    '''
 
-'''Final Clean Up'''
-#Ranking to arrange cash flow statement line by line
-cashflow_ranking_dict = {'Operating Profit':1,'Depreciation Expense':2,'AP':3,'AR':3,'Inventory':3,'Unearned Ad Revenue':3,'Taxes Paid':4,'Equipment':6,'Dividends paid':8,'Proceeds from issuance':8,
-                        'Cash as of end of '+str(prev_last_year):11,'Cash as of end of '+str(last_year):11,'Cash as of '+str(date_input):11 }
 
-#Ranking to segregate into cash flow from operations, investing, financing, and final reconciliation
-cashflow_type_dict = {'Operating Profit':'Cashflow from Operations','Depreciation Expense':'Cashflow from Operations','AP':'Cashflow from Operations','AR':'Cashflow from Operations','Inventory':'Cashflow from Operations',
-                        'Unearned Ad Revenue':'Cashflow from Operations','Taxes Paid':'Cashflow from Operations','Equipment':'Cashflow from Investing','Dividends paid':'Cashflow from Financing','Proceeds from issuance':'Cashflow from Financing',
-                        'Cash as of end of '+str(prev_last_year):'Final Reconciliation','Cash as of end of '+str(last_year):'Final Reconciliation','Cash as of '+str(date_input):'Final Reconciliation' }
 
+    with span('profit_loss') as record:
+        #Filter out this year and previous year data only for P&L generation
+        profit_loss_this_year = profit_loss_total[ (profit_loss_total['Year'] == this_year) | (profit_loss_total['Year'] == last_year) ]
 
+        #P&L generation for YTD data - Only take data up to current quarter only
+        profit_loss_year_output = profit_loss_this_year[profit_loss_this_year['Quarter'] <= this_quarter ]
 
+        #Group P&L by T_Account_Name,year,group, and ranking (drop quarter data)
+        profit_loss_year_output = profit_loss_year_output.groupby(['T_Account_Name','Year','group','ranking']).sum().reset_index()
 
-#Rename T_Account to category
-cashflow_stmt_output = cashflow_stmt_output.rename(columns = {'T_Account_Name':'Category'})
+        profit_loss_year_output = profit_loss_year_output.sort_values('ranking')
 
+        #Pivot table to show this year and last year's P&L as column data instead
+        profit_loss_year_output = profit_loss_year_output.pivot_table('Balance',['T_Account_Name','ranking'],'Year').reset_index().sort_values('ranking')
 
+        #Round all numbers to 2 dp
+        profit_loss_year_output = profit_loss_year_output.round(2)
+        record['Rows'] = len(profit_loss_year_output)
 
-#Pivot table to show years as columns in cashflow statement
-cashflow_stmt_output = cashflow_stmt_output.pivot_table('Balance',['Category'],'Year').reset_index()
+    with span('balance_sheet') as record:
+        #Running balance of every balance sheet account, by quarter
+        balance_sheet_balances = RunningBalance(balance_sheet)
 
-#Place rank mapping into cashflow statement to arrange data for export
-cashflow_stmt_output['ranking'] = cashflow_stmt_output['Category'].map(cashflow_ranking_dict)
+        #Balance Sheet - Balances as of this quarter of last year and this year
+        for year in [last_year,this_year]:
 
-#Add second ranking to push all cash balances to the bottom of the statement
-cashflow_stmt_output['ranking_main'] = cashflow_stmt_output.Category.apply(lambda x: 2 if 'Cash as of' in x else 1 )
+            #For every year, take all T Accounts up to the end of this quarter of the year
+            balances = balance_sheet_balances.as_of(year, this_quarter)
+            balance_sheet_year_loop = pd.DataFrame({'T_Account_Name': balances.index, 'asset_grouping': balances.index.map(chart['Category']), 'Balance': balances.to_numpy()})
+            balance_sheet_year_loop = balance_sheet_year_loop[balance_sheet_year_loop['asset_grouping'].notnull()]
 
-#Place cashflow type mapping into cashflow statement
-cashflow_stmt_output['Cashflow type'] = cashflow_stmt_output['Category'].map(cashflow_type_dict)
+            #Convert negative credit values to positive values
+            balance_sheet_year_loop['Balance'] = np.where( balance_sheet_year_loop['asset_grouping'].isin(['Equity','Liabilities']), abs(balance_sheet_year_loop['Balance']), balance_sheet_year_loop['Balance'])
 
-#sort out cashflow statement
-cashflow_stmt_output = cashflow_stmt_output.sort_values(['ranking_main','ranking','Category'])
+            #Add year to balance sheet df to be used to pivot later
+            balance_sheet_year_loop['Year'] = year
 
-#Filter out final cash balances, then rearrange them to show initial and final cash balance
-cashflow_final_balance = cashflow_stmt_output[cashflow_stmt_output['ranking_main'] == 2]
-#Value of cash balances over the years, return 0 if error
-try:
-    cashflow_balance_prev_last_year = np.sum(cashflow_final_balance[prev_last_year])
-except:
-    cashflow_balance_prev_last_year = 0
+            #sort balance sheet by asset grouping Asset--> Equity --> Liabilities
+            balance_sheet_year_loop = balance_sheet_year_loop.sort_values('asset_grouping')
 
-try:
-    cashflow_balance_last_year = np.sum(cashflow_final_balance[last_year])
-except:
-    cashflow_balance_last_year = 0
+            balance_sheet_output = pd.concat([balance_sheet_output,balance_sheet_year_loop])
+        record['Rows'] = len(balance_sheet)
 
-cash_initial_dict = {'Category':'Cash and cash equivalents, beginning of period',prev_last_year:0,last_year:cashflow_balance_prev_last_year,
-                    this_year:cashflow_balance_last_year,'ranking':11, 'ranking_main':2,'Cashflow type':'Final Reconciliation' }
+    '''New loop to calculate line items required for cash flow statement
+    Data required from the past 3 years: P&L for the full year, AP/AR balances, Depreciation Expense, Operating Profit, Taxes Paid, Dividends Paid, Purchase or Disposal of equipment'''
 
 
-cash_final_dict = {'Category':'Cash and cash equivalents, end of period',prev_last_year:0,last_year: cashflow_balance_last_year,
-                    this_year:np.sum(cashflow_final_balance[this_year]),'ranking':12, 'ranking_main':2,'Cashflow type':'Final Reconciliation' }
+    with span('cash_flow') as record:
+        #Running totals of the P&L lines, by quarter
+        profit_loss_balances = RunningBalance(profit_loss_total)
+        cashflow_stmt_output = cash_flow_statement(ledger.store, balance_sheet_balances, profit_loss_balances, chart, date_input)
+        record['Rows'] = len(cashflow_stmt_output)
 
+    with span('equity') as record:
+        #Movements of every year, with the equity type in columns
+        stmt_equity_output = stmt_equity.groupby(['Category','Equity Type','Year']).sum().reset_index()
+        stmt_equity_output = stmt_equity_output.pivot_table('Balance',['Category','Year'],'Equity Type').sort_values(['Year','Category']).fillna(0).reset_index()
 
+        #Retrieve the Retained Earnings and Share Capital Amounts at the end of each year from the running balances of each equity type
+        equity_balances = RunningBalance(stmt_equity, key = 'Equity Type')
+        equity_balance = lambda year: equity_balances.as_of(year).reindex(['Common Stock','Retained Earnings'], fill_value = 0.0)
 
-#Remove cash balances from cashflow output, then append dictionaries back in
-cashflow_stmt_output = cashflow_stmt_output[cashflow_stmt_output['ranking_main'] == 1]
+        equity_stmt_beg = {'Category':'Balance as of end of '+str(prev_last_year),'Year':str(prev_last_year), **equity_balance(prev_last_year)}
+        equity_stmt_mid = {'Category':'Balance as of end of '+str(last_year),'Year':str(last_year), **equity_balance(last_year)}
+        equity_stmt_end = {'Category':'Balance as of  '+str(date_input),'Year': str(this_year), **equity_balance(this_year)}
 
-try:
-    cashflow_from_ops_last_year = np.sum(cashflow_stmt_output[cashflow_stmt_output['ranking'] <=4 ][last_year])
-    cashflow_from_inv_last_year = np.sum(cashflow_stmt_output[(cashflow_stmt_output['ranking'] >4) & (cashflow_stmt_output['ranking'] <=7) ][last_year])
-    cashflow_from_fin_last_year = np.sum(cashflow_stmt_output[(cashflow_stmt_output['ranking'] >7) & (cashflow_stmt_output['ranking'] <=9) ][last_year])
-    cashflow_total_last_year = np.sum(cashflow_stmt_output[last_year])
-except:
-    cashflow_from_ops_last_year = 0
-    cashflow_from_inv_last_year = 0
-    cashflow_from_fin_last_year = 0
-    cashflow_total_last_year = 0
+        equity_stmt_add = pd.DataFrame([equity_stmt_beg,equity_stmt_mid,equity_stmt_end])
 
-#Create subtotal and total for cash flows from operations, investing, financing, and total cash change
-cashflow_from_operations_dict = {'Category':'Net cash from operations',prev_last_year:0,last_year:cashflow_from_ops_last_year,
-                    this_year:np.sum(cashflow_stmt_output[cashflow_stmt_output['ranking'] <=4 ][this_year]),'ranking':5, 'ranking_main':1,'Cashflow type':'Cashflow from Operations' }
+        #Filter out equity statement line items for the past 2 years only
+        stmt_equity_output = stmt_equity_output[stmt_equity_output['Year'].astype(int) >= last_year]
 
-cashflow_from_investing_dict = {'Category':'Net cash from investing',prev_last_year:0,last_year:cashflow_from_inv_last_year,
-                    this_year:np.sum(cashflow_stmt_output[(cashflow_stmt_output['ranking'] >4) & (cashflow_stmt_output['ranking'] <=7)][this_year]),'ranking':7, 'ranking_main':1,'Cashflow type':'Cashflow from Investing' }
+        #stmt_equity_output round to 2 decimal places
+        stmt_equiity_output = stmt_equity_output.round(2)
 
-cashflow_from_financing_dict = {'Category':'Net cash from financing',prev_last_year:0,last_year:cashflow_from_fin_last_year,
-                    this_year:np.sum(cashflow_stmt_output[(cashflow_stmt_output['ranking'] >7) & (cashflow_stmt_output['ranking'] <=9) ][this_year]),'ranking':9, 'ranking_main':1,'Cashflow type':'Cashflow from Financing' }
+        #Concatenate starting equity balances into equity statement dataframe
+        stmt_equity_output = pd.concat([stmt_equity_output,equity_stmt_add],axis = 0,ignore_index = True)
 
-cashflow_change_total = {'Category':'Net change in cash and cash equivalents',prev_last_year:0,last_year:cashflow_total_last_year,
-                    this_year:np.sum(cashflow_stmt_output[this_year]),'ranking':10, 'ranking_main':1,'Cashflow type':'Net change in cash' }
-#Prepare dictionaries to export back to cashflow statement
-cash_balance_join = pd.DataFrame([cash_initial_dict,cash_final_dict,cashflow_from_operations_dict,cashflow_from_investing_dict,cashflow_from_financing_dict,cashflow_change_total])
+        #Define row mapping to set equity statement output to correct rows
 
+        mapping_dict = {'Dividends paid':3,'Proceeds from issuance':1,'Profit/Loss':2,'Balance as of end of '+str(prev_last_year):4,'Balance as of end of '+str(last_year):4,'Balance as of end of '+str(date_input):4}
 
-#Join cash balances back to dataframe
-cashflow_stmt_output = pd.concat([cashflow_stmt_output,cash_balance_join],axis = 0,ignore_index = True)
-#Resort dataframe
-cashflow_stmt_output = cashflow_stmt_output.sort_values(['ranking_main','ranking','Category']).fillna(0)
+        #Add mapping to equity statement
+        stmt_equity_output['ranking'] = stmt_equity_output['Category'].map(mapping_dict)
 
-#Only keep relevant data columns for export
-cashflow_stmt_output = cashflow_stmt_output[['Category',last_year,this_year,'Cashflow type']]
+        #Arrange equity statement accordingly for export
+        stmt_equity_output = stmt_equity_output.sort_values(['Year','ranking']).drop(columns = 'ranking')
 
+        stmt_equity_output['Total'] = stmt_equity_output['Retained Earnings'] + stmt_equity_output['Common Stock']
 
-#Round all numbers to 2 decimal places
-cashflow_stmt_output = cashflow_stmt_output.round(2)
+        #Round all numbers to 2 decimal places
+        stmt_equity_output = stmt_equity_output.round(2)
+        record['Rows'] = len(stmt_equity_output)
 
-#pivot table to place equity type in columns
-stmt_equity_output = stmt_equity_output.pivot_table('Balance',['Category','Year'],'Equity Type').sort_values(['Year','Category']).fillna(0).reset_index()
+    with span('balance_sheet') as record:
+        #Filter out balance sheet line items that are < $0.01
+        balance_sheet_output = balance_sheet_output.round(2)
+        balance_sheet_output = balance_sheet_output[balance_sheet_output['Balance'] >= 0.005 ]
 
+        #Pivot balance sheet to show yearly data in column
+        balance_sheet_output = balance_sheet_output.pivot_table('Balance',['T_Account_Name','asset_grouping'],'Year').reset_index().sort_values('asset_grouping')
 
-#Retrieve the initial Retained Earnings and Share Capital Amounts 2 years before the year of date of input to prepare output
-equity_stmt_beg = {'Category':'Balance as of end of '+str(prev_last_year),'Year':str(prev_last_year),'Common Stock':np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < last_year ]['Common Stock'] ), 'Retained Earnings': np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < last_year ]['Retained Earnings'] ) }
-equity_stmt_mid = {'Category':'Balance as of end of '+str(last_year),'Year':str(last_year),'Common Stock':np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < this_year ]['Common Stock'] ), 'Retained Earnings': np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < this_year ]['Retained Earnings'] )}
-equity_stmt_end = {'Category':'Balance as of  '+str(date_input),'Year': str(this_year),'Common Stock':np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < this_year+1 ]['Common Stock'] ), 'Retained Earnings': np.sum(stmt_equity_output[stmt_equity_output['Year'].astype(int) < this_year+1 ]['Retained Earnings'] ) }
+        #Fill NA columns with 0
+        balance_sheet_output = balance_sheet_output.fillna(0)
+        record['Rows'] = len(balance_sheet_output)
 
-equity_stmt_add = pd.DataFrame([equity_stmt_beg,equity_stmt_mid,equity_stmt_end])
 
-#Filter out equity statement line items for the past 2 years only
-stmt_equity_output = stmt_equity_output[stmt_equity_output['Year'].astype(int) >= last_year]
 
-#stmt_equity_output round to 2 decimal places
-stmt_equiity_output = stmt_equity_output.round(2)
+    #Prepare output - drop ranking and group
+    profit_loss_year_output = profit_loss_year_output.drop(columns = ['ranking']).rename(columns= {'T_Account_Name': 'P&L Category'})
+    profit_loss_total = profit_loss_total.drop(columns = ['ranking','group']).rename(columns= {'T_Account_Name': 'P&L Category'})
+    balance_sheet_output = balance_sheet_output.rename(columns= {'T_Account_Name': 'Category','asset_grouping':'Asset Category',last_year:str(last_year)+'Q'+str(this_quarter),this_year:str(this_year)+'Q'+str(this_quarter)})
 
-#Concatenate starting equity balances into equity statement dataframe
-stmt_equity_output = pd.concat([stmt_equity_output,equity_stmt_add],axis = 0,ignore_index = True)
+    #Remove tax payable txn for current year which was calculated before the date of input, and append tax payable to transaction
+    #Remove previous tax transaction that was previously calculated
+    df = df[(df['Credit_Amount'] != 'Tax Payable')]
+    df = df.sort_values('Date')
 
-#Define row mapping to set equity statement output to correct rows
+    '''
+    Ending: Return P&L,Balance Sheet, Inventory and Transactions, 1 sheet each
+    '''
+    return {'Profit & Loss YTD': profit_loss_year_output, 'Balance Sheet Today': balance_sheet_output, 'Stmt of Chng to Equity': stmt_equity_output,
+            'Cash Flow Statement': cashflow_stmt_output, 'Inventory Warehouse': inventory_warehouse.reset_index(), 'Inventory Shop': inventory_shops,
+            'Transactions Cleaned': df, 'Inventory Stock Check': inventory_data_final, 'Revenue Exceptions': revenue_exceptions}
 
-mapping_dict = {'Dividends paid':3,'Proceeds from issuance':1,'Profit/Loss':2,'Balance as of end of '+str(prev_last_year):4,'Balance as of end of '+str(last_year):4,'Balance as of end of '+str(date_input):4}
 
-#Add mapping to equity statement
-stmt_equity_output['ranking'] = stmt_equity_output['Category'].map(mapping_dict)
+#Generate statements for several dates of report (e.g. every quarter end) in 1 chronological pass over the ledger
+#Returns the statements of each date, keyed by date in YYYY-MM-DD format
+def generate_statement_series(ledger, dates):
+    dates = sorted(set(pd.Timestamp(date).normalize() for date in dates))
 
-#Arrange equity statement accordingly for export
-stmt_equity_output = stmt_equity_output.sort_values(['Year','ranking']).drop(columns = 'ranking')
+    #Inventory of each date continues from the inventory of the date before
+    for date in dates:
+        ledger.inventory_as_of(date)
 
-stmt_equity_output['Total'] = stmt_equity_output['Retained Earnings'] + stmt_equity_output['Common Stock']
+    t_account_balances = ledger.trial_balances(dates)
+    statements = {}
+    for date in dates:
+        with span('statements') as record:
+            statements[date.strftime('%Y-%m-%d')] = generate_statements(ledger, date, t_account_balances[date])
+            record['Rows'] = len(statements[date.strftime('%Y-%m-%d')]['Transactions Cleaned'])
+    return statements
 
-#Round all numbers to 2 decimal places
-stmt_equity_output = stmt_equity_output.round(2)
 
-#Filter out balance sheet line items that are < $0.01
-balance_sheet_output = balance_sheet_output.round(2)
-balance_sheet_output = balance_sheet_output[balance_sheet_output['Balance'] >= 0.005 ]
+#Generate all statements as of the date of report from a workbook of transactions
+def close_books(workbook, date_input, use_snapshot = True, chart_file = None, levels_file = None):
+    ledger = Ledger(workbook, use_snapshot, chart_file, levels_file)
+    with span('statements') as record:
+        statements = generate_statements(ledger, date_input)
+        record['Rows'] = len(statements['Transactions Cleaned'])
+    return statements
 
-#Pivot balance sheet to show yearly data in column
-balance_sheet_output = balance_sheet_output.pivot_table('Balance',['T_Account_Name','asset_grouping'],'Year').reset_index().sort_values('asset_grouping')
 
-#Fill NA columns with 0
-balance_sheet_output = balance_sheet_output.fillna(0)
+'''
+Statement cache: statements already generated are kept in memory, keyed by the fingerprint of the ledger up to the date of report, the date and the statement.
+The least recently used statements are dropped once the cache is full. With a folder, statements are also saved to disk and read back from there,
+e.g. by the next run. Transactions added after a date only change the fingerprint of later dates, so statements of earlier dates are still found
+'''
 
+#Statements kept in the cache
+cached_statements = ['Profit & Loss YTD','Balance Sheet Today','Stmt of Chng to Equity','Cash Flow Statement','Inventory Stock Check']
+
+
+class StatementCache:
+
+    def __init__(self, max_mb = 256, folder = None):
+        self.max_bytes = max_mb * 2**20
+        self.folder = folder
+        #(fingerprint, date, statement) -> (statement, size in bytes), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def _file(self, key):
+        fingerprint, date_input, statement = key
+        return os.path.join(self.folder, date_input + ' ' + hashlib.sha256((fingerprint + statement).encode()).hexdigest()[:32] + '.pkl')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0].copy()
+        if self.folder is not None and os.path.exists(self._file(key)):
+            statement = pd.read_pickle(self._file(key))
+            self._keep(key, statement)
+            with self.lock:
+                self.disk_hits += 1
+            return statement.copy()
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, statement):
+        self._keep(key, statement.copy())
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok = True)
+            statement.to_pickle(self._file(key))
+
+    #Add to memory and drop the least recently used statements until the cache fits, a statement larger than the cache is not kept in memory
+    def _keep(self, key, statement):
+        size = int(statement.memory_usage(index = True, deep = True).sum())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (statement, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last = False)[1][1]
+
+    #Cached statements of a ledger as of a date, None if any of them is missing
+    def lookup(self, ledger, as_of):
+        date_input = pd.Timestamp(as_of).strftime('%Y-%m-%d')
+        fingerprint = ledger.fingerprint(date_input)
+        statements = {}
+        for statement in cached_statements:
+            statements[statement] = self.get((fingerprint, date_input, statement))
+            if statements[statement] is None:
+                return None
+        return statements
+
+    def store(self, ledger, as_of, statements):
+        date_input = pd.Timestamp(as_of).strftime('%Y-%m-%d')
+        fingerprint = ledger.fingerprint(date_input)
+        for statement in cached_statements:
+            self.put((fingerprint, date_input, statement), statements[statement])
+
+    #Statements of a ledger as of a date, generated only if they are not in the cache
+    def statements(self, ledger, as_of):
+        statements = self.lookup(ledger, as_of)
+        if statements is None:
+            statements = generate_statements(ledger, as_of)
+            self.store(ledger, as_of, statements)
+            statements = {statement: statements[statement] for statement in cached_statements}
+        return statements
+
+    #Drop the statements of dates on or after a date, in memory and on disk, e.g. after transactions on that date were added or edited
+    def invalidate(self, from_date):
+        from_date = pd.Timestamp(from_date).strftime('%Y-%m-%d')
+        with self.lock:
+            for key in [key for key in self.entries if key[1] >= from_date]:
+                self.size -= self.entries.pop(key)[1]
+        if self.folder is not None and os.path.isdir(self.folder):
+            for file_name in os.listdir(self.folder):
+                if file_name.endswith('.pkl') and file_name[:10] >= from_date:
+                    os.remove(os.path.join(self.folder, file_name))
 
 
-#Prepare output - drop ranking and group
-profit_loss_year_output = profit_loss_year_output.drop(columns = ['ranking']).rename(columns= {'T_Account_Name': 'P&L Category'})
-profit_loss_total = profit_loss_total.drop(columns = ['ranking','group']).rename(columns= {'T_Account_Name': 'P&L Category'})
-balance_sheet_output = balance_sheet_output.rename(columns= {'T_Account_Name': 'Category','asset_grouping':'Asset Category',last_year:str(last_year)+'Q'+str(this_quarter),this_year:str(this_year)+'Q'+str(this_quarter)})
+'''
+Output: sheets are written row by row with xlsxwriter in constant memory mode, so that large sheets are not held in memory twice.
+The journal (Transactions Cleaned) can be written to a Parquet or CSV file instead, and each sheet can be written to its own workbook in parallel
+'''
 
-#Remove tax payable txn for current year which was calculated before the date of input, and append tax payable to transaction
-#Find year of date of input
-date_input_output = date_input[:10]
-#Remove previous tax transaction that was previously calculated
-df = df[(df['Credit_Amount'] != 'Tax Payable')]
-df = df.sort_values('Date')
+#Column types of the journal file, all other columns are written as text
+journal_types = {'Date': 'datetime64[ns]', 'Debit_Amount': float, 'Credit_Amount': float, 'Quantity': float, 'Year': 'Int64', 'Quarter': 'Int64'}
+
+
+#Write the cleaned journal to a CSV or Parquet file, 1 chunk at a time
+class JournalWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.started = False
+        self.parquet_writer = None
+
+    def write(self, journal):
+        if self.columns is None:
+            self.columns = list(journal.columns)
+        journal = journal.reindex(columns = self.columns)
+
+        for column in self.columns:
+            if column in journal_types:
+                journal[column] = pd.to_numeric(journal[column], errors = 'coerce').astype(journal_types[column]) if column != 'Date' else pd.to_datetime(journal[column])
+            else:
+                journal[column] = journal[column].astype(object).where(journal[column].isnull(), journal[column].astype(str))
+
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.parquet_writer is None:
+                schema = pa.Schema.from_pandas(journal, preserve_index = False)
+                schema = pa.schema([pa.field(field.name, pa.string()) if field.name not in journal_types else field for field in schema])
+                self.parquet_writer = pq.ParquetWriter(self.path, schema)
+            self.parquet_writer.write_table(pa.Table.from_pandas(journal, schema = self.parquet_writer.schema, preserve_index = False))
+        else:
+            journal.to_csv(self.path, mode = 'a' if self.started else 'w', header = not self.started, index = False)
+        self.started = True
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+#Writer and values of every column of a sheet. Numbers and dates are converted once per column (dates to Excel serial numbers),
+#other columns are written value by value. Missing values are left blank and infinite values are written as 'inf', as pandas does
+def column_writers(worksheet, sheet, date_format):
+    writers = []
+    for column in sheet.columns:
+        values = sheet[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            serial = ((values - pd.Timestamp('1899-12-30')) / pd.Timedelta(days = 1)).to_numpy(dtype = float)
+            writers.append((worksheet.write_number, [None if np.isnan(x) else x for x in serial.tolist()], date_format))
+        elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            numbers = values.to_numpy(dtype = float)
+            writers.append((worksheet.write, [None if np.isnan(x) else ('inf' if x > 0 else '-inf') if np.isinf(x) else x for x in numbers.tolist()], None))
+        else:
+            writers.append((worksheet.write, [None if pd.isnull(x) else x for x in values.astype(object).tolist()], None))
+    return writers
+
+
+#Write sheets into 1 Excel workbook, falls back to pandas' default Excel writer if xlsxwriter is not installed
+def write_workbook(sheets, output_file):
+    try:
+        import xlsxwriter
+    except ImportError:
+        with pd.ExcelWriter(output_file) as writer:
+            for sheet_name, sheet in sheets.items():
+                sheet.to_excel(writer, sheet_name = sheet_name, index = False)
+        return output_file
+
+    #In constant memory mode every row has to be written in full before the next one, which is why pandas' to_excel (column by column) cannot be used
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    for sheet_name, sheet in sheets.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, [int(column) if isinstance(column, (int, np.integer)) else str(column) for column in sheet.columns], header_format)
+
+        writers = column_writers(worksheet, sheet, date_format)
+        for row in range(len(sheet)):
+            for column, (write, values, cell_format) in enumerate(writers):
+                if values[row] is not None:
+                    write(row + 1, column, values[row], cell_format)
+    workbook.close()
+    return output_file
 
 
-'''
-Ending: Export P&L,Balance Sheet, Inventory and Transactions into a single sheet
-'''
 #Export Financial Statements to Excel
-with pd.ExcelWriter( str(date_input_output)+str(' ')+'FS_BS.xlsx') as writer:
-    profit_loss_year_output.to_excel(writer, sheet_name='Profit & Loss YTD', index = False)
-    balance_sheet_output.to_excel(writer, sheet_name='Balance Sheet Today', index = False)
-    stmt_equity_output.to_excel(writer, sheet_name='Stmt of Chng to Equity', index = False)
-    cashflow_stmt_output.to_excel(writer, sheet_name='Cash Flow Statement', index = False)
-    inventory_warehouse.to_excel(writer, sheet_name='Inventory Warehouse', index = True)
-    inventory_shops.to_excel(writer, sheet_name='Inventory Shop', index = False)
-    df.to_excel(writer, sheet_name='Transactions Cleaned', index = False)
-    inventory_data_final.to_excel(writer, sheet_name = 'Inventory Stock Check', index = False)
+#journal_file: write Transactions Cleaned to this Parquet or CSV file instead of a sheet
+#split: write each sheet to its own workbook ("<output> - <sheet>.xlsx"), with up to `workers` processes in parallel
+def write_statements(statements, output_file, journal_file = None, split = False, workers = None):
+    statements = dict(statements)
+    with span('export') as record:
+        record['Rows'] = sum(len(sheet) for sheet in statements.values())
+        if journal_file is not None and 'Transactions Cleaned' in statements:
+            writer = JournalWriter(journal_file)
+            writer.write(statements.pop('Transactions Cleaned'))
+            writer.close()
+
+        if not split:
+            return [write_workbook(statements, output_file)]
+
+        stem = os.path.splitext(output_file)[0]
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(write_workbook, {sheet_name: sheet}, stem + ' - ' + sheet_name + '.xlsx') for sheet_name, sheet in statements.items()]
+            return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate P&L, balance sheet, statement of changes to equity, cash flow statement and inventory as of a date')
+    parser.add_argument('--date', nargs = '+', help = 'date(s) of report in YYYY-MM-DD format (asked for if not given)')
+    parser.add_argument('--quarter-ends', nargs = 2, metavar = ('FROM', 'TO'), help = 'generate a report for every quarter end between 2 dates')
+    parser.add_argument('--input', default = 'Transactions_Raw.xlsx', help = 'workbook with the Transaction, Price List and Shop Space sheets')
+    parser.add_argument('--output', help = 'Excel file to write for a single date (default: "<date> FS_BS.xlsx")')
+    parser.add_argument('--chart', help = 'chart of accounts, a CSV file or a workbook with a Chart of Accounts sheet (default: Chart_of_Accounts.csv)')
+    parser.add_argument('--levels', help = 'inventory level thresholds per item and shop, a CSV file or a workbook with an Inventory Levels sheet')
+    parser.add_argument('--alerts', action = 'store_true', help = 'add an Inventory Alerts sheet with the days items dropped to Low or Empty')
+    parser.add_argument('--no-snapshot', action = 'store_true', help = 'recalculate everything from the first transaction')
+    parser.add_argument('--shop-workers', type = int, default = None, help = 'process the inventory of the shops in this many processes (at least 4), 1 shop at a time')
+    parser.add_argument('--journal', choices = ['parquet','csv'], help = 'write Transactions Cleaned to "<output> Journal.parquet/.csv" instead of a sheet')
+    parser.add_argument('--split-sheets', action = 'store_true', help = 'write every sheet to its own workbook, in parallel')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of processes for --split-sheets (default: number of cores)')
+    parser.add_argument('--diagnostics', choices = ['sheet','json'], help = 'time each phase, as a Run Diagnostics sheet or "<output> Diagnostics.json"')
+    args = parser.parse_args()
+
+    diagnostics = enable_diagnostics() if args.diagnostics else None
+
+    ledger = Ledger(args.input, use_snapshot = not args.no_snapshot, chart_file = args.chart, levels_file = args.levels)
+    ledger.inventory_workers = args.shop_workers
+
+    dates = list(args.date or [])
+    if args.quarter_ends:
+        #Skip quarter ends before the first transaction
+        quarter_ends = pd.date_range(args.quarter_ends[0], args.quarter_ends[1], freq = 'Q')
+        dates.extend(quarter_ends[quarter_ends >= ledger.transactions['Date'].min()])
+    if not dates:
+        dates = [input('Please key in the date of report in YYYY-MM-DD format:')]
+    dates = [pd.Timestamp(date).strftime('%Y-%m-%d') for date in dates]
+    if args.output and len(set(dates)) > 1:
+        parser.error('--output can only be used with a single date of report')
+
+    for date_input, statements in generate_statement_series(ledger, dates).items():
+        output_file = args.output or date_input + ' FS_BS.xlsx'
+        journal_file = os.path.splitext(output_file)[0] + ' Journal.' + args.journal if args.journal else None
+        if args.alerts:
+            statements['Inventory Alerts'] = ledger.inventory_alerts(date_input, ['Low','Empty'])
+        #The sheet shows the spans of the run so far, up to the export of this workbook
+        if args.diagnostics == 'sheet':
+            statements['Run Diagnostics'] = diagnostics.to_frame()
+        write_statements(statements, output_file, journal_file, args.split_sheets, args.workers)
+        if args.diagnostics == 'json':
+            diagnostics.write_json(os.path.splitext(output_file)[0] + ' Diagnostics.json')
+    ledger.close()
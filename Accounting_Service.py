@@ -0,0 +1,156 @@
+#This script will serve the financial statements of 1 workbook over HTTP on the local machine
+#The workbook is loaded once and the ledger is kept in memory, so inventory, COGS Expense and T-Accounts already processed are not processed again
+#Statements are generated in a pool of worker threads, so that the server keeps accepting requests while a report is calculated,
+#and kept in a cache so that the same report is only calculated once
+
+#Usage: python Accounting_Service.py --input Transactions_Raw.xlsx --port 8080
+#Then: http://127.0.0.1:8080/statements/balance-sheet?date=2023-12-31 (JSON), add &format=xlsx for an Excel file
+#Reports: profit-loss, balance-sheet, equity, cash-flow, stock-check, or /statements for all of them
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+
+from Accounting_Demo import Ledger, StatementCache, generate_statements, workbook_cache_dir, write_workbook
+
+
+#Sheet of each report in the statements
+report_sheets = {'profit-loss': 'Profit & Loss YTD', 'balance-sheet': 'Balance Sheet Today', 'equity': 'Stmt of Chng to Equity',
+                 'cash-flow': 'Cash Flow Statement', 'stock-check': 'Inventory Stock Check'}
+
+content_types = {'json': 'application/json', 'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+
+status_text = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+#Error returned to the client with its HTTP status
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReportService:
+
+    def __init__(self, ledger, workers = None, cache = None):
+        self.ledger = ledger
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        #The ledger keeps the inventory of every date processed, only 1 worker at a time may update it
+        self.ledger_lock = threading.Lock()
+        self.cache = cache if cache is not None else StatementCache()
+
+    #Statements from the cache, or generated from the ledger
+    def statements(self, date_input):
+        statements = self.cache.lookup(self.ledger, date_input)
+        if statements is None:
+            with self.ledger_lock:
+                statements = generate_statements(self.ledger, date_input)
+            self.cache.store(self.ledger, date_input, statements)
+        return statements
+
+    #Body of the response for 1 or all reports as of a date, as JSON or an Excel workbook
+    def render(self, reports, date_input, output_format):
+        try:
+            statements = self.statements(date_input)
+        except ValueError as error:
+            raise RequestError(400, str(error))
+        sheets = {report_sheets[report]: statements[report_sheets[report]] for report in reports}
+
+        if output_format == 'xlsx':
+            output = io.BytesIO()
+            write_workbook(sheets, output)
+            return output.getvalue()
+
+        body = ', '.join(json.dumps(sheet_name) + ': ' + sheet.to_json(orient = 'records', date_format = 'iso') for sheet_name, sheet in sheets.items())
+        return ('{"date": ' + json.dumps(date_input) + ', "statements": {' + body + '}}').encode()
+
+    #Reports, date of report and format asked for in the URL, the date defaults to the latest transaction
+    def parse_target(self, target):
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/').split('/')[1:]
+
+        if path == ['health']:
+            return None, None, None
+        if path == ['statements']:
+            reports = list(report_sheets)
+        elif len(path) == 2 and path[0] == 'statements' and path[1] in report_sheets:
+            reports = [path[1]]
+        else:
+            raise RequestError(404, 'Unknown report, use /statements or /statements/<report> with report one of: ' + ', '.join(report_sheets))
+
+        output_format = query.get('format', 'json')
+        if output_format not in content_types:
+            raise RequestError(400, 'format must be json or xlsx')
+        try:
+            date_input = pd.Timestamp(query.get('date') or self.ledger.transactions['Date'].max()).strftime('%Y-%m-%d')
+        except ValueError:
+            raise RequestError(400, 'date must be in YYYY-MM-DD format')
+        return reports, date_input, output_format
+
+    async def respond(self, method, target):
+        if method != 'GET':
+            raise RequestError(405, 'Only GET requests are served')
+        reports, date_input, output_format = self.parse_target(target)
+        if reports is None:
+            processed_date = None if self.ledger.processed_date == pd.Timestamp.min else str(self.ledger.processed_date.date())
+            cache = {'statements': len(self.cache.entries), 'mb': round(self.cache.size / 2**20, 1), 'hits': self.cache.hits, 'disk_hits': self.cache.disk_hits, 'misses': self.cache.misses}
+            return 200, 'application/json', json.dumps({'status': 'ok', 'workbook': self.ledger.workbook, 'processed_date': processed_date, 'cache': cache}).encode()
+
+        body = await asyncio.get_running_loop().run_in_executor(self.pool, self.render, reports, date_input, output_format)
+        return 200, content_types[output_format], body
+
+    #1 request per connection: read the request line and headers, answer, and close the connection
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            try:
+                if len(request_line) != 3:
+                    raise RequestError(400, 'Malformed request')
+                status, content_type, body = await self.respond(request_line[0], request_line[1])
+            except RequestError as error:
+                status, content_type, body = error.status, 'application/json', json.dumps({'error': str(error)}).encode()
+            except Exception as error:
+                status, content_type, body = 500, 'application/json', json.dumps({'error': type(error).__name__ + ': ' + str(error)}).encode()
+
+            headers = ['HTTP/1.1 ' + str(status) + ' ' + status_text[status], 'Content-Type: ' + content_type,
+                       'Content-Length: ' + str(len(body)), 'Connection: close']
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host = '127.0.0.1', port = 8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving ' + self.ledger.workbook + ' on http://' + host + ':' + str(port) + '/statements')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve the financial statements of a workbook over HTTP, keeping the ledger in memory')
+    parser.add_argument('--input', default = 'Transactions_Raw.xlsx', help = 'workbook with the Transaction, Price List and Shop Space sheets')
+    parser.add_argument('--chart', help = 'chart of accounts, a CSV file or a workbook with a Chart of Accounts sheet (default: Chart_of_Accounts.csv)')
+    parser.add_argument('--levels', help = 'inventory level thresholds per item and shop, a CSV file or a workbook with an Inventory Levels sheet')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on (default: this machine only)')
+    parser.add_argument('--port', type = int, default = 8080, help = 'port to listen on')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of worker threads for reports')
+    parser.add_argument('--cache-mb', type = int, default = 256, help = 'memory for statements already generated, in MB')
+    parser.add_argument('--disk-cache', action = 'store_true', help = "also save generated statements in the workbook's .ledger_cache folder, for the next run")
+    parser.add_argument('--no-snapshot', action = 'store_true', help = 'recalculate everything from the first transaction')
+    args = parser.parse_args()
+
+    ledger = Ledger(args.input, use_snapshot = not args.no_snapshot, chart_file = args.chart, levels_file = args.levels)
+    cache = StatementCache(args.cache_mb, os.path.join(workbook_cache_dir(args.input), 'Statements') if args.disk_cache else None)
+    asyncio.run(ReportService(ledger, args.workers, cache).serve(args.host, args.port))
@@ -0,0 +1,214 @@
+#This script will generate the financial statements from a transaction list that is too large to be loaded at once
+#Transactions are read from a CSV or Parquet file (same columns as the Transaction sheet, sorted by date) in chunks of complete days
+#Inventory, COGS Expense and T-Account totals are updated chunk by chunk, and the cleaned journal is written out chunk by chunk
+#Price List and Shop Space are read from a workbook laid out like Transactions_Raw.xlsx
+
+#Usage: python Accounting_Stream.py 2023-12-31 Transactions.csv --reference Transactions_Raw.xlsx --journal "2023-12-31 Journal.csv" --chunksize 100000
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from Accounting_Demo import (InventoryState, run_inventory_engine, inventory_transactions, build_price_index, build_t_accounts, trial_balance,
+                             account_table, load_chart_of_accounts, load_level_thresholds, read_workbook, generate_statements, write_statements, JournalWriter,
+                             TransactionStore, statement_pairs, span, enable_diagnostics)
+
+
+#Read transactions in chunks of about chunksize rows, from a CSV or Parquet file
+def read_chunks(path, chunksize):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize = chunksize):
+            yield chunk
+
+
+#Set the column types used by the script, the same way as the cached Transaction sheet
+def clean_chunk(chunk):
+    chunk['Date'] = pd.to_datetime(chunk['Date'])
+    for column in chunk.columns:
+        if column in ['Debit','Credit','Item_Name']:
+            chunk[column] = chunk[column].astype(object)
+        elif chunk[column].dtype == object:
+            chunk[column] = chunk[column].where(chunk[column].isnull(), chunk[column].astype(str))
+    return chunk
+
+
+#Split a date ordered source into chunks of complete days up to the date of report, as a day has to be processed in 1 go
+def day_chunks(chunks, as_of):
+    pending = None
+    last_date = pd.Timestamp.min
+    for chunk in chunks:
+        chunk = clean_chunk(chunk)
+        if len(chunk) == 0:
+            continue
+        previous_date = chunk['Date'].shift(fill_value = last_date)
+        out_of_order = chunk['Date'] < previous_date
+        if out_of_order.any():
+            row = out_of_order.idxmax()
+            raise ValueError('Transactions must be sorted by date, found ' + str(chunk['Date'][row].date()) + ' after ' + str(previous_date[row].date()))
+        last_date = chunk['Date'].iloc[-1]
+
+        chunk = chunk[chunk['Date'] <= as_of]
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], axis = 0, ignore_index = True)
+
+        #Keep the last day of the chunk until the next chunk, it may continue there
+        if len(chunk):
+            last_day = chunk['Date'] == chunk['Date'].iloc[-1]
+            pending = chunk[last_day]
+            if (~last_day).any():
+                yield chunk[~last_day]
+
+        if last_date > as_of:
+            break
+
+    if pending is not None and len(pending):
+        yield pending
+
+
+#Transactions that generate_statements reads directly (not only through the T-Accounts), the account pairs in statement_pairs:
+#share issues, dividends, and the cash transactions in cashflow_pairs. Everything else is only kept as T-Account totals
+def statement_transactions(df):
+    keep = np.zeros(len(df), dtype = bool)
+    for debit, credit in statement_pairs:
+        keep |= ( (debit is None) | (df['Debit'] == debit) ).to_numpy() & ( (credit is None) | (df['Credit'] == credit) ).to_numpy()
+    return df[keep]
+
+
+#Ledger built from a stream of transactions up to 1 date of report, can be passed to generate_statements in place of a Ledger
+#Only keeps the inventory, revenue exceptions, quarterly T-Account totals, the dates with transactions and the transactions in statement_transactions
+class StreamingLedger:
+
+    def __init__(self, price_list, shop_space, as_of, chart_file = None, levels_file = None):
+        self.price_list = price_list
+        self.shop_space = shop_space
+        self.price_index = build_price_index(price_list)
+        self.as_of = pd.Timestamp(as_of)
+
+        #Accounts seen so far, classified from the chart of accounts
+        self.chart = load_chart_of_accounts(chart_file)
+        self.accounts = account_table([], self.chart)
+        self.level_thresholds = load_level_thresholds(levels_file)
+
+        self.inventory_state = InventoryState()
+        self.transactions = None
+        self._store = None
+        self.revenue_exceptions = None
+        self.quarterly_balance = None
+        self.dates = np.array([], dtype = 'datetime64[ns]')
+
+    #Process 1 chunk of complete days, returns the cleaned journal of the chunk (transactions and their COGS Expense)
+    def process(self, chunk):
+        #Accounts missing from the chart of accounts are rejected before the chunk is processed
+        self.accounts = account_table(pd.concat([self.accounts['T_Account_Name'], chunk['Debit'], chunk['Credit']]), self.chart)
+
+        with span('inventory') as record:
+            inventory_txns = inventory_transactions(chunk, self.accounts)
+            self.inventory_state, cogs_txns, revenue_exceptions = run_inventory_engine(inventory_txns, self.price_index, self.inventory_state, accounts = self.accounts)
+            record['Rows'] = len(inventory_txns)
+        journal = pd.concat([chunk, cogs_txns], axis = 0, ignore_index = True).sort_values('Date', kind = 'mergesort')
+
+        #Add the chunk's T-Account totals per year and quarter to the totals so far
+        with span('t_accounts') as record:
+            quarterly_balance = trial_balance(build_t_accounts(journal))
+            if self.quarterly_balance is not None:
+                quarterly_balance = pd.concat([self.quarterly_balance, quarterly_balance], axis = 0)
+            quarterly_balance = quarterly_balance.groupby(['T_Account_Name','Year','Quarter'])[['Debit_Amount','Credit_Amount']].sum()
+            quarterly_balance['Balance'] = quarterly_balance['Debit_Amount'] + quarterly_balance['Credit_Amount']
+            self.quarterly_balance = quarterly_balance.reset_index()
+            record['Rows'] = len(journal)
+
+        self.transactions = pd.concat([self.transactions, statement_transactions(chunk)], axis = 0, ignore_index = True)
+        self._store = None
+        self.revenue_exceptions = pd.concat([self.revenue_exceptions, revenue_exceptions], axis = 0, ignore_index = True)
+        self.dates = np.concatenate([self.dates, chunk['Date'].unique()])
+
+        return journal.assign(Year = journal['Date'].dt.year, Quarter = journal['Date'].dt.quarter)
+
+    '''
+    Same methods as Ledger, only for the date of report the stream was processed up to
+    '''
+
+    def check_date(self, as_of):
+        if pd.Timestamp(as_of) != self.as_of:
+            raise ValueError('Streaming ledger was processed up to ' + str(self.as_of.date()) + ' only')
+
+    def inventory_as_of(self, as_of):
+        self.check_date(as_of)
+        return self.inventory_state
+
+    def transaction_dates(self, as_of):
+        self.check_date(as_of)
+        return self.dates
+
+    def trial_balances(self, dates):
+        for date in dates:
+            self.check_date(date)
+        return {self.as_of: self.quarterly_balance}
+
+    #Index of the transactions kept, rebuilt after a chunk is processed
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = TransactionStore(self.transactions)
+        return self._store
+
+    @property
+    def cogs_txns(self):
+        #COGS Expense transactions are written to the journal file instead of being kept
+        return self.transactions.iloc[:0]
+
+
+#Stream the transactions up to the date of report, write the cleaned journal, and return the statements (without the Transactions Cleaned sheet)
+def stream_statements(source, reference_workbook, date_input, journal_file, chunksize = 100000, chart_file = None, levels_file = None):
+    sheets = read_workbook(reference_workbook, ['Price List','Shop Space'])
+    ledger = StreamingLedger(sheets['Price List'], sheets['Shop Space'], date_input, chart_file, levels_file)
+
+    writer = JournalWriter(journal_file)
+    try:
+        for chunk in day_chunks(read_chunks(source, chunksize), ledger.as_of):
+            writer.write(ledger.process(chunk))
+
+        if ledger.transactions is None:
+            raise ValueError('No transactions on or before ' + str(date_input))
+
+        with span('statements'):
+            statements = generate_statements(ledger, date_input)
+
+        #Calculated tax entries are only known once all transactions are processed, they are added at the end of the journal
+        transactions_cleaned = statements.pop('Transactions Cleaned')
+        writer.write(transactions_cleaned[transactions_cleaned['Comments'] == 'Calculated Tax Payable'])
+    finally:
+        writer.close()
+
+    return statements
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate financial statements from a large transaction list, reading it in chunks')
+    parser.add_argument('date', help = 'date of report in YYYY-MM-DD format')
+    parser.add_argument('source', help = 'CSV or Parquet file of transactions (Transaction sheet columns), sorted by date')
+    parser.add_argument('--reference', default = 'Transactions_Raw.xlsx', help = 'workbook with the Price List and Shop Space sheets')
+    parser.add_argument('--journal', help = 'CSV or Parquet file for the cleaned journal (default: "<date> Journal.csv")')
+    parser.add_argument('--output', help = 'Excel file for the statements (default: "<date> FS_BS.xlsx")')
+    parser.add_argument('--chart', help = 'chart of accounts, a CSV file or a workbook with a Chart of Accounts sheet (default: Chart_of_Accounts.csv)')
+    parser.add_argument('--levels', help = 'inventory level thresholds per item and shop, a CSV file or a workbook with an Inventory Levels sheet')
+    parser.add_argument('--chunksize', type = int, default = 100000, help = 'number of transactions to read at a time')
+    parser.add_argument('--diagnostics', choices = ['sheet','json'], help = 'time each phase, as a Run Diagnostics sheet or "<output> Diagnostics.json"')
+    args = parser.parse_args()
+
+    diagnostics = enable_diagnostics() if args.diagnostics else None
+
+    date_input = pd.Timestamp(args.date).strftime('%Y-%m-%d')
+    output_file = args.output or date_input + ' FS_BS.xlsx'
+    statements = stream_statements(args.source, args.reference, date_input, args.journal or date_input + ' Journal.csv', args.chunksize, args.chart, args.levels)
+    if args.diagnostics == 'sheet':
+        statements['Run Diagnostics'] = diagnostics.to_frame()
+    write_statements(statements, output_file)
+    if args.diagnostics == 'json':
+        diagnostics.write_json(os.path.splitext(output_file)[0] + ' Diagnostics.json')